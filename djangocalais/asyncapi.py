@@ -0,0 +1,380 @@
+'''
+An event-driven OpenCalais client.
+
+``OpenCalais`` blocks on every request, so keeping many documents in
+flight means one thread per document. ``AsyncOpenCalais`` drives all of
+its requests from a single ``asyncore`` event loop instead, with at most
+``concurrency`` connections open at once. It shares request building,
+gzip handling, result caching and JSON/RDF post-processing with
+``OpenCalais``.
+
+Example::
+
+    api = AsyncOpenCalais(settings.CALAIS_API_KEY, concurrency=200)
+    pending = [api.analyze(text) for text in texts]
+    api.run()
+    results = [r.result for r in pending]
+
+Host names are resolved with the blocking resolver when a connection is
+opened. HTTPS connections verify the server's certificate where Python
+can (2.7.9 and later), as ``urllib2`` does.
+'''
+import asyncore, socket, ssl, sys, time, urlparse, zlib
+from djangocalais import metrics
+from djangocalais.calaisapi import OpenCalais, CHUNK_SIZE, ResponseTooLarge, \
+     log
+
+
+class AsyncResult(object):
+    """
+    The eventual result of an asynchronous call. ``result`` is filled
+    in, and ``callback`` (if any) called with it, when the call
+    finishes. Failed calls produce ``{}``, just like ``OpenCalais``.
+    """
+    def __init__(self, callback=None):
+        self.callback = callback
+        self.done = False
+        self.result = None
+
+    def set(self, result):
+        self.done = True
+        self.result = result
+        if self.callback is not None:
+            self.callback(result)
+
+
+# Most bytes one character takes in any of the encodings Calais accepts
+MAX_CHAR_BYTES = 4
+
+def _wrap_tls(sock, hostname):
+    """
+    Wrap the connected ``sock`` for TLS without handshaking yet.
+    """
+    if hasattr(ssl, 'create_default_context'):
+        return ssl.create_default_context().wrap_socket(
+            sock, server_hostname=hostname, do_handshake_on_connect=False)
+    return ssl.wrap_socket(sock, do_handshake_on_connect=False)
+
+
+class HTTPRequest(asyncore.dispatcher):
+    """
+    A single non-blocking HTTP/1.0 or HTTPS request. ``finish`` is
+    called once with ``(status, headers, body)`` on success or with an
+    exception instance on failure. A response larger than ``max_size``
+    bytes fails, while one whose body reaches ``max_body`` bytes is
+    cut short there.
+    """
+    def __init__(self, method, url, body, headers, finish, socket_map,
+                 timeout, max_size=None, max_body=None):
+        asyncore.dispatcher.__init__(self, map=socket_map)
+        parts = urlparse.urlsplit(url)
+        if parts.scheme not in ('http', 'https'):
+            raise ValueError('Unsupported URL scheme: %s' % url)
+        path = parts.path or '/'
+        if parts.query:
+            path = '%s?%s' % (path, parts.query)
+        lines = ['%s %s HTTP/1.0' % (method, path), 'Host: %s' % parts.netloc]
+        for name, value in headers.items():
+            lines.append('%s: %s' % (name, value))
+        if body is not None:
+            lines.append('Content-Length: %d' % len(body))
+        self.outgoing = '\r\n'.join(lines) + '\r\n\r\n' + (body or '')
+        self.incoming = []
+        self.received = 0
+        self.head_size = None
+        self.max_size = max_size
+        self.max_body = max_body
+        self.finish = finish
+        self.deadline = time.time() + timeout
+        self.finished = False
+        self.hostname = parts.hostname
+        self.tls = parts.scheme == 'https'
+        self.handshaking = False
+        self.want_write = False
+        self.create_socket(socket.AF_INET, socket.SOCK_STREAM)
+        try:
+            self.connect((parts.hostname,
+                          parts.port or (self.tls and 443 or 80)))
+        except socket.error:
+            self.close()
+            raise
+
+    def writable(self):
+        if self.handshaking:
+            return self.want_write
+        return not self.connected or bool(self.outgoing)
+
+    def handle_connect(self):
+        if self.tls:
+            self.socket = _wrap_tls(self.socket, self.hostname)
+            self.handshaking = True
+
+    def _handshake(self):
+        try:
+            self.socket.do_handshake()
+        except ssl.SSLError, e:
+            if e.args[0] not in (ssl.SSL_ERROR_WANT_READ,
+                                 ssl.SSL_ERROR_WANT_WRITE):
+                raise
+            self.want_write = e.args[0] == ssl.SSL_ERROR_WANT_WRITE
+        else:
+            self.handshaking = False
+
+    def handle_write(self):
+        if self.handshaking:
+            self._handshake()
+            return
+        try:
+            sent = self.send(self.outgoing)
+        except ssl.SSLError, e:
+            if e.args[0] != ssl.SSL_ERROR_WANT_WRITE:
+                raise
+            return
+        self.outgoing = self.outgoing[sent:]
+
+    def handle_read(self):
+        if self.handshaking:
+            self._handshake()
+            return
+        while not self.finished:
+            try:
+                data = self.recv(CHUNK_SIZE)
+            except ssl.SSLError, e:
+                if e.args[0] != ssl.SSL_ERROR_WANT_READ:
+                    raise
+                return
+            if not data:
+                return
+            self.incoming.append(data)
+            self.received += len(data)
+            if self.max_size is not None and self.received > self.max_size:
+                self.close()
+                self._finish(ResponseTooLarge(
+                    'Response exceeds %d bytes' % self.max_size))
+            elif self.max_body is not None and \
+                    self._body_size() >= self.max_body:
+                # enough of the body has arrived; stop downloading
+                self.close()
+                self._respond()
+            # TLS may hold decrypted data that select() will not report
+            if not self.tls or not self.connected or \
+                    not self.socket.pending():
+                return
+
+    def _body_size(self):
+        if self.head_size is None:
+            head, sep, body = ''.join(self.incoming).partition('\r\n\r\n')
+            if not sep:
+                return 0
+            self.head_size = len(head) + len(sep)
+        return self.received - self.head_size
+
+    def handle_close(self):
+        self.close()
+        if not self.finished:
+            self._respond()
+
+    def _respond(self):
+        try:
+            response = self.parse_response(''.join(self.incoming))
+        except ValueError, e:
+            self._finish(e)
+        else:
+            self._finish(response)
+
+    def handle_error(self):
+        self.close()
+        self._finish(sys.exc_info()[1])
+
+    def check_timeout(self, now):
+        if now > self.deadline and not self.finished:
+            self.close()
+            self._finish(socket.timeout('Request timed out'))
+
+    def _finish(self, value):
+        if not self.finished:
+            self.finished = True
+            self.finish(value)
+
+    def parse_response(self, data):
+        head, sep, body = data.partition('\r\n\r\n')
+        if not sep:
+            raise ValueError('Incomplete HTTP response')
+        lines = head.split('\r\n')
+        status = int(lines[0].split(None, 2)[1])
+        headers = {}
+        for line in lines[1:]:
+            name, sep, value = line.partition(':')
+            headers[name.strip().lower()] = value.strip()
+        if headers.get('content-encoding', '') == 'gzip':
+            started = metrics.start()
+            decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+            if self.max_size is None:
+                body = decompressor.decompress(body)
+            else:
+                body = decompressor.decompress(body, self.max_size + 1)
+                if len(body) > self.max_size:
+                    raise ResponseTooLarge(
+                        'Response exceeds %d bytes' % self.max_size)
+            metrics.stop('calais.gunzip', started)
+        metrics.incr('calais.response_bytes', len(body))
+        return status, headers, body
+
+
+class AsyncOpenCalais(OpenCalais):
+    """
+    An ``OpenCalais`` client whose ``analyze`` and ``analyze_url``
+    return an ``AsyncResult`` immediately. Requests are started by
+    :meth:`run`, which keeps up to ``concurrency`` connections open
+    and returns when every request has finished.
+
+    Failed requests are not retried or rate limited, and connections
+    are not pooled, so the ``rate_limiter``, ``max_retries``,
+    ``deadline`` and ``pool_size`` arguments of ``OpenCalais`` raise
+    ``TypeError``.
+    """
+    max_redirects = 5
+
+    def __init__(self, api_key, concurrency=100, timeout=60, **kwargs):
+        for name in ('rate_limiter', 'max_retries', 'deadline', 'pool_size'):
+            if name in kwargs:
+                raise TypeError('AsyncOpenCalais does not support the %r '
+                                'argument' % name)
+        OpenCalais.__init__(self, api_key, timeout=timeout, max_retries=0,
+                            **kwargs)
+        self.concurrency = concurrency
+        self.timeout = timeout
+        self._map = {}
+        self._pending = []
+        self._active = []
+
+    def _make_pool(self, pool_size, timeout):
+        return None
+
+    def _request(self, method, url, body, headers, finish, max_body=None):
+        self._pending.append((method, url, body, headers, finish, max_body))
+
+    def _start_pending(self):
+        self._active = [r for r in self._active if not r.finished]
+        while self._pending and len(self._active) < self.concurrency:
+            method, url, body, headers, finish, max_body = \
+                self._pending.pop(0)
+            try:
+                request = HTTPRequest(method, url, body, headers, finish,
+                                      self._map, self.timeout,
+                                      self.max_response_size, max_body)
+            except (socket.error, ValueError), e:
+                finish(e)
+            else:
+                self._active.append(request)
+
+    def run(self):
+        """
+        Process requests until all of them, including any queued by
+        callbacks along the way, have finished.
+        """
+        self._start_pending()
+        while self._pending or self._active:
+            if self._map:
+                asyncore.loop(timeout=1, map=self._map, count=1)
+            now = time.time()
+            for request in self._active:
+                request.check_timeout(now)
+            self._start_pending()
+
+    def analyze(self, text, content_type='text/html',
+                output_format='application/json', encoding='utf8',
+                size_limit=100000, raw=False, callback=None):
+        """
+        Queue ``text`` for analysis. Arguments are the same as for
+        ``OpenCalais.analyze``; ``callback`` is called with the result
+        once it is available.
+        """
+        async_result = AsyncResult(callback)
+        if len(text) > size_limit:
+            text = text[:size_limit]
+        externalID = self._hash_text(text, encoding=encoding)
+        cache_key = None
+        if self.cache is not None:
+            cache_key = self.cache.make_key(externalID, content_type,
+                                            output_format)
+            cached = self.cache.get(cache_key)
+            if cached is not None:
+                async_result.set(cached)
+                return async_result
+        param = self._encode_params(text, content_type, output_format,
+                                    externalID, encoding)
+        metrics.incr('calais.request_bytes', len(param))
+        started = metrics.start()
+
+        def finish(response):
+            metrics.stop('calais.http', started)
+            if isinstance(response, Exception):
+                metrics.incr('calais.errors')
+                log.error('Failed to reach the Calais server: %s', response)
+                async_result.set({})
+                return
+            status, headers, data = response
+            if status != 200:
+                metrics.incr('calais.errors')
+                log.error("The Calais server couldn't fulfill the request. "
+                          "Error code: %s", status)
+                async_result.set({})
+                return
+            try:
+                result = self.construct_response(data, output_format)
+            except Exception, e:
+                metrics.incr('calais.errors')
+                log.exception('Failed to decode the Calais response: %s', e)
+                result = {}
+            if cache_key is not None and result:
+                self.cache.set(cache_key, result)
+            async_result.set(result)
+
+        self._request('POST', self.url, param, self.REQUEST_HEADERS,
+                      finish)
+        return async_result
+
+    def analyze_url(self, url, content_type='text/html',
+                    output_format='application/json', encoding='utf8',
+                    size_limit=100000, callback=None):
+        """
+        Queue the document at ``url`` to be retrieved and analyzed.
+        Redirects are followed. As with ``OpenCalais.analyze_url``,
+        only about as much of the document as will be submitted
+        (``size_limit`` characters) is downloaded.
+        """
+        async_result = AsyncResult(callback)
+        headers = {'User-Agent': 'Python OpenCalaisAPI',
+                   'Accept-encoding': 'gzip'}
+        max_body = size_limit * MAX_CHAR_BYTES
+
+        def fetched(response, url=url, redirects=0):
+            if isinstance(response, Exception):
+                metrics.incr('calais.errors')
+                log.error('analyze_url() failed to load %s: %s', url,
+                          response)
+                async_result.set({})
+                return
+            status, response_headers, data = response
+            location = response_headers.get('location')
+            if status in (301, 302, 303, 307) and location and \
+                    redirects < self.max_redirects:
+                location = urlparse.urljoin(url, location)
+                self._request('GET', location, None, headers,
+                              lambda r: fetched(r, location, redirects + 1),
+                              max_body)
+                return
+            if status != 200:
+                metrics.incr('calais.errors')
+                log.error("analyze_url() failed: the server couldn't fulfill "
+                          "the request. Error code: %s", status)
+                async_result.set({})
+                return
+            self.analyze(data.decode(encoding, 'ignore')[:size_limit],
+                         content_type=content_type,
+                         output_format=output_format, encoding=encoding,
+                         size_limit=size_limit, callback=async_result.set)
+
+        self._request('GET', url, None, headers, fetched, max_body)
+        return async_result
@@ -0,0 +1,151 @@
+"""
+Analysis in a background worker instead of the request that saved an
+object.
+
+With ``CALAIS_BACKGROUND_ANALYSIS = True`` in your settings (or after
+calling :func:`connect`), saving an object of any model that has a
+``calais_content_fields`` attribute adds an ``AnalysisRequest`` row
+for it instead of contacting OpenCalais. A request only becomes due
+``CALAIS_QUEUE_DELAY`` seconds (default 10) after the object was last
+saved, so an object saved many times in a row is analyzed once.
+
+The queue is an ordinary database table, so no message broker is
+needed. Drain it with::
+
+    python manage.py calais_worker
+
+Several workers may run at once; each request is claimed by one
+worker for ``CALAIS_QUEUE_LEASE`` seconds (default 300) while it is
+analyzed. Failed analyses are retried with exponential backoff, up to
+``CALAIS_QUEUE_MAX_ATTEMPTS`` times (default 5).
+"""
+import logging, time
+from datetime import datetime, timedelta
+from django.conf import settings
+from django.contrib.contenttypes.models import ContentType
+from django.core.exceptions import ObjectDoesNotExist
+from django.db.models import F, Q
+from django.db.models.signals import post_save
+from djangocalais.models import AnalysisRequest, CalaisDocument
+from djangocalais.upsert import insert_ignore
+
+QUEUE_DELAY = getattr(settings, 'CALAIS_QUEUE_DELAY', 10)
+QUEUE_LEASE = getattr(settings, 'CALAIS_QUEUE_LEASE', 300)
+QUEUE_MAX_ATTEMPTS = getattr(settings, 'CALAIS_QUEUE_MAX_ATTEMPTS', 5)
+
+log = logging.getLogger('djangocalais')
+
+
+def enqueue(obj, delay=None):
+    """
+    Queue ``obj`` to be analyzed ``delay`` seconds from now (by default
+    ``CALAIS_QUEUE_DELAY``). If it is already queued, its request is
+    postponed instead.
+    """
+    if delay is None:
+        delay = QUEUE_DELAY
+    content_type = ContentType.objects.get_for_model(obj)
+    due = datetime.now() + timedelta(seconds=delay)
+    request = AnalysisRequest(content_type=content_type, object_id=obj.pk,
+                              due=due)
+    if not insert_ignore(AnalysisRequest, [request]):
+        AnalysisRequest.objects.filter(
+            content_type=content_type, object_id=obj.pk).update(due=due)
+
+def handle_save(sender, instance, raw=False, **kwargs):
+    if not raw and hasattr(sender, 'calais_content_fields'):
+        enqueue(instance)
+
+def connect():
+    """
+    Queue objects of every model with ``calais_content_fields`` for
+    analysis whenever they are saved.
+    """
+    post_save.connect(handle_save, dispatch_uid='djangocalais.background')
+
+def disconnect():
+    post_save.disconnect(dispatch_uid='djangocalais.background')
+
+def _claim(request, now):
+    """
+    Lock ``request`` for this worker. Fails if another worker holds it
+    or the object was saved again since ``request`` was read.
+    """
+    unlocked = Q(locked_until__isnull=True) | Q(locked_until__lt=now)
+    return AnalysisRequest.objects.filter(unlocked, pk=request.pk,
+                                          due=request.due).update(
+        locked_until=now + timedelta(seconds=QUEUE_LEASE))
+
+def _analyze(obj, api):
+    """
+    Analyze the changed fields of ``obj`` and store the results. Returns
+    the names of the fields OpenCalais failed to analyze, since it
+    reports errors and timeouts as empty results rather than raising.
+    Fields that were analyzed are not sent again on a retry.
+    """
+    manager = CalaisDocument.objects
+    document, changed, previous = manager._plan(obj, None, False)
+    if not changed:
+        return []
+    results = manager.analyze_fields(obj, changed, api)
+    manager._store(document, obj, changed, previous, results, True)
+    return [field_name for (field_name, content_type), result
+            in zip(changed, results) if not result]
+
+def process_queue(api=None, batch_size=100):
+    """
+    Analyze up to ``batch_size`` objects whose requests are due and
+    return the number of requests handled.
+    """
+    now = datetime.now()
+    unlocked = Q(locked_until__isnull=True) | Q(locked_until__lt=now)
+    requests = AnalysisRequest.objects.filter(unlocked, due__lte=now) \
+                                      .order_by('due')[:batch_size]
+    handled = 0
+    for request in list(requests):
+        if not _claim(request, now):
+            continue
+        handled += 1
+        queued = AnalysisRequest.objects.filter(pk=request.pk)
+        try:
+            obj = request.content_type.get_object_for_this_type(
+                pk=request.object_id)
+        except ObjectDoesNotExist:
+            queued.delete()
+            continue
+        try:
+            failed = _analyze(obj, api)
+            if failed:
+                log.warning('Failed to analyze %s of %s',
+                            ', '.join(failed), request)
+        except Exception, e:
+            log.exception('Failed to analyze %s: %s', request, e)
+            failed = True
+        if failed:
+            if request.attempts + 1 >= QUEUE_MAX_ATTEMPTS:
+                queued.delete()
+            else:
+                retry = datetime.now() + timedelta(
+                    seconds=QUEUE_DELAY * 2 ** request.attempts)
+                queued.update(attempts=F('attempts') + 1, due=retry,
+                              locked_until=None)
+            continue
+        # a save during the analysis moved ``due``; keep that request
+        queued.filter(due=request.due).delete()
+        queued.update(locked_until=None)
+    return handled
+
+def run_worker(api=None, batch_size=100, interval=1.0, once=False):
+    """
+    Process the queue until interrupted, sleeping ``interval`` seconds
+    whenever nothing is due. With ``once``, return as soon as nothing
+    is due. Returns the number of requests handled.
+    """
+    total = 0
+    while True:
+        handled = process_queue(api, batch_size)
+        total += handled
+        if not handled:
+            if once:
+                return total
+            time.sleep(interval)
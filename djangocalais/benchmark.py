@@ -0,0 +1,243 @@
+"""
+Offline benchmarks for djangocalais.
+
+Each benchmark returns a list of dictionaries, one per measurement,
+ready to be written out as JSON and compared between runs. None of
+them contact OpenCalais: requests go to a ``FakeCalaisServer`` that
+replays synthetic (or recorded) responses. The ``calais_benchmark``
+management command runs them all.
+"""
+import random, time
+from xml.dom import minidom
+try:
+    import simplejson as json
+except ImportError:
+    import json
+from djangocalais.calaisapi import OpenCalais
+from djangocalais.fakeserver import FakeCalaisServer
+from djangocalais.parser import CalaisParser
+from djangocalais.utils import parallel_map
+
+ENTITY_TYPES = ('Person', 'Company', 'City', 'Organization', 'Product')
+RELATION_TYPES = ('PersonCareer', 'Acquisition', 'CompanyAffiliates')
+
+TYPE_URL = 'http://s.opencalais.com/1/type/em/%s/%s'
+DOC_URL = 'http://d.opencalais.com/dochash-1/benchmark'
+
+
+def make_json_response(entities=10, relations=None, social_tags=5,
+                       topics=2, seed=0):
+    """
+    Return a synthetic OpenCalais JSON response with the given number of
+    entities, relations (by default a fifth of the entities), social
+    tags and topics.
+    """
+    rnd = random.Random(seed)
+    if relations is None:
+        relations = entities // 5
+    data = {'doc': {'info': {'document': 'Benchmark document',
+                             'docId': DOC_URL}}}
+    uris = []
+    for i in range(entities):
+        uri = 'http://d.opencalais.com/genericHasher-1/entity-%d' % i
+        etype = ENTITY_TYPES[i % len(ENTITY_TYPES)]
+        uris.append(uri)
+        data[uri] = {'_typeGroup': 'entities', '_type': etype,
+                     '_typeReference': TYPE_URL % ('e', etype),
+                     'name': 'Entity %d' % i,
+                     'relevance': round(rnd.random(), 3),
+                     'instances': [{'detection': '[]Entity %d[]' % i,
+                                    'exact': 'Entity %d' % i,
+                                    'offset': i * 20, 'length': 10}]}
+    for i in range(relations):
+        uri = 'http://d.opencalais.com/genericHasher-1/relation-%d' % i
+        rtype = RELATION_TYPES[i % len(RELATION_TYPES)]
+        data[uri] = {'_typeGroup': 'relations', '_type': rtype,
+                     '_typeReference': TYPE_URL % ('r', rtype),
+                     'subject': uris and rnd.choice(uris) or '',
+                     'object': uris and rnd.choice(uris) or '',
+                     'instances': [{'offset': i * 40, 'length': 30}]}
+    for i in range(social_tags):
+        data['http://d.opencalais.com/dochash-1/benchmark/SocialTag/%d'
+             % i] = {'_typeGroup': 'socialTag',
+                     'socialTag': 'http://d.opencalais.com/tag/%d' % i,
+                     'name': 'Tag %d' % i, 'importance': 1 + i % 2}
+    for i in range(topics):
+        data['http://d.opencalais.com/dochash-1/benchmark/cat/%d'
+             % i] = {'_typeGroup': 'topics',
+                     'category': 'http://d.opencalais.com/cat/%d' % i,
+                     'categoryName': 'Topic %d' % i,
+                     'score': round(rnd.random(), 3)}
+    return json.dumps(data)
+
+def make_rdf_response(entities=10, relations=None, seed=0):
+    """
+    Return a synthetic OpenCalais RDF response with the given number of
+    entities and relations (by default a fifth of the entities). There
+    is no whitespace between elements, as in real responses.
+    """
+    rnd = random.Random(seed)
+    if relations is None:
+        relations = entities // 5
+    parts = ['<?xml version="1.0" encoding="utf-8"?>',
+             '<!--Use of the Calais Web Service is governed by the Terms '
+             'of Service-->',
+             '<rdf:RDF xmlns:rdf="http://www.w3.org/1999/02/22-rdf-syntax-'
+             'ns#" xmlns:c="http://s.opencalais.com/1/pred/">',
+             '<rdf:Description rdf:about="%s"><rdf:type rdf:resource="'
+             'http://s.opencalais.com/1/type/sys/DocInfo"/><c:document>'
+             'Benchmark document</c:document></rdf:Description>' % DOC_URL]
+    uris = []
+    for i in range(entities):
+        uri = 'http://d.opencalais.com/genericHasher-1/entity-%d' % i
+        etype = ENTITY_TYPES[i % len(ENTITY_TYPES)]
+        uris.append(uri)
+        parts.append(
+            '<rdf:Description rdf:about="%s"><rdf:type rdf:resource="%s"/>'
+            '<c:name>Entity %d</c:name></rdf:Description>'
+            % (uri, TYPE_URL % ('e', etype), i))
+        parts.append(
+            '<rdf:Description rdf:about="%s/Instance/%d"><rdf:type '
+            'rdf:resource="http://s.opencalais.com/1/type/sys/InstanceInfo"'
+            '/><c:docId rdf:resource="%s"/><c:subject rdf:resource="%s"/>'
+            '<c:exact>Entity %d</c:exact><c:offset>%d</c:offset><c:length>'
+            '10</c:length></rdf:Description>'
+            % (DOC_URL, i, DOC_URL, uri, i, i * 20))
+        parts.append(
+            '<rdf:Description rdf:about="%s/Relevance/%d"><rdf:type '
+            'rdf:resource="http://s.opencalais.com/1/type/sys/RelevanceInfo"'
+            '/><c:docId rdf:resource="%s"/><c:subject rdf:resource="%s"/>'
+            '<c:relevance>%.3f</c:relevance></rdf:Description>'
+            % (DOC_URL, i, DOC_URL, uri, rnd.random()))
+    for i in range(relations):
+        rtype = RELATION_TYPES[i % len(RELATION_TYPES)]
+        parts.append(
+            '<rdf:Description rdf:about="http://d.opencalais.com/'
+            'genericHasher-1/relation-%d"><rdf:type rdf:resource="%s"/>'
+            '<c:subject rdf:resource="%s"/><c:object rdf:resource="%s"/>'
+            '</rdf:Description>'
+            % (i, TYPE_URL % ('r', rtype), rnd.choice(uris),
+               rnd.choice(uris)))
+    parts.append('</rdf:RDF>')
+    return ''.join(parts)
+
+def _best_time(func, arg, repeat):
+    """
+    Return the fastest of ``repeat`` timed calls of ``func(arg)``.
+    """
+    best = None
+    for i in range(repeat):
+        start = time.time()
+        func(arg)
+        elapsed = time.time() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best
+
+def _parse_minidom(data):
+    return CalaisParser(minidom.parseString(data).documentElement).results
+
+def bench_parsers(sizes=(10, 100, 1000), repeat=5, recorded=None):
+    """
+    Time ``construct_json_response``, ``construct_rdf_response`` and
+    the minidom-based ``CalaisParser`` on responses with each number
+    of entities in ``sizes``. ``recorded`` may map ``'json'`` and
+    ``'rdf'`` to recorded responses, which are timed as well.
+    """
+    api = OpenCalais('benchmark')
+    payloads = []
+    for size in sizes:
+        payloads.append((size, 'json', make_json_response(size)))
+        payloads.append((size, 'rdf', make_rdf_response(size)))
+    for kind, data in (recorded or {}).items():
+        if data:
+            payloads.append(('recorded', kind, data))
+    parsers = {'json': (('construct_json_response',
+                         api.construct_json_response),),
+               'rdf': (('construct_rdf_response', api.construct_rdf_response),
+                       ('CalaisParser', _parse_minidom))}
+    rows = []
+    for size, kind, data in payloads:
+        for name, func in parsers[kind]:
+            seconds = _best_time(func, data, repeat)
+            rows.append({'benchmark': 'parse', 'parser': name,
+                         'entities': size, 'bytes': len(data),
+                         'seconds': seconds,
+                         'mb_per_sec': seconds and
+                                       len(data) / seconds / 1e6 or None})
+    return rows
+
+def bench_client(requests=100, concurrency=4, latency=0, error_rate=0,
+                 gzip=True, output_format='application/json', entities=50,
+                 json_response=None, rdf_response=None):
+    """
+    Send ``requests`` analysis requests, ``concurrency`` at a time,
+    through ``OpenCalais.analyze`` to a fake server that answers after
+    ``latency`` seconds and fails a fraction ``error_rate`` of them.
+    Failed requests are not retried.
+    """
+    server = FakeCalaisServer(
+        json_response=json_response or make_json_response(entities),
+        rdf_response=rdf_response or make_rdf_response(entities),
+        latency=latency, error_rate=error_rate, gzip=gzip, seed=0).start()
+    api = OpenCalais('benchmark', url=server.url, pool_size=concurrency,
+                     max_retries=0)
+    try:
+        texts = ['Benchmark document %d' % i for i in range(requests)]
+        start = time.time()
+        results = parallel_map(
+            lambda text: api.analyze(text, output_format=output_format),
+            texts, concurrency)
+        elapsed = time.time() - start
+    finally:
+        api.pool.close()
+        server.stop()
+    return [{'benchmark': 'client', 'requests': requests,
+             'concurrency': concurrency, 'latency': latency,
+             'error_rate': error_rate, 'gzip': gzip,
+             'output_format': output_format, 'seconds': elapsed,
+             'requests_per_sec': requests / elapsed,
+             'failed': len([r for r in results if not r])}]
+
+def bench_analyze(objects, fields=None, entities=50, json_response=None):
+    """
+    Analyze each of ``objects`` with ``CalaisDocumentManager.analyze``
+    against a fake server, first storing new results and then
+    re-analyzing with everything already stored, with and without
+    ``bulk``. Reports database queries and seconds per document. This
+    writes to the database, so run it against a test database.
+    """
+    from django.db import connection, reset_queries
+    from djangocalais.models import CalaisDocument, Entity, EventFact, \
+         SocialTag, Topic
+    server = FakeCalaisServer(
+        json_response=json_response or make_json_response(entities)).start()
+    api = OpenCalais('benchmark', url=server.url)
+    use_debug_cursor = connection.use_debug_cursor
+    connection.use_debug_cursor = True
+    rows = []
+    try:
+        for bulk in (False, True):
+            for model in (CalaisDocument, Entity, EventFact, SocialTag,
+                          Topic):
+                model._default_manager.all().delete()
+            for run in ('new', 'existing'):
+                queries = 0
+                start = time.time()
+                for obj in objects:
+                    reset_queries()
+                    CalaisDocument.objects.analyze(obj, fields, api=api,
+                                                   bulk=bulk, force=True)
+                    queries += len(connection.queries)
+                elapsed = time.time() - start
+                count = len(objects) or 1
+                rows.append({'benchmark': 'analyze', 'bulk': bulk,
+                             'run': run, 'documents': len(objects),
+                             'queries_per_document': queries / float(count),
+                             'seconds_per_document': elapsed / count})
+    finally:
+        connection.use_debug_cursor = use_debug_cursor
+        reset_queries()
+        api.pool.close()
+        server.stop()
+    return rows
@@ -0,0 +1,313 @@
+"""
+Caches used by djangocalais.
+
+``LRUCache`` and ``InstanceCache`` are deliberately simple: they live
+in the memory of a single process, are bounded in size and are safe to
+share between threads. The result caches store parsed OpenCalais
+responses so that identical text is never submitted twice.
+"""
+import hashlib, os, tempfile, threading, time
+from collections import OrderedDict
+try:
+    from cPickle import loads, dumps, HIGHEST_PROTOCOL
+except ImportError:
+    from pickle import loads, dumps, HIGHEST_PROTOCOL
+
+
+class LRUCache(object):
+    """
+    A thread-safe mapping that holds at most ``max_size`` items,
+    discarding the least recently used item when it is full.
+    """
+    def __init__(self, max_size=1000):
+        self.max_size = max_size
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        self._lock.acquire()
+        try:
+            try:
+                value = self._data.pop(key)
+            except KeyError:
+                return default
+            self._data[key] = value
+            return value
+        finally:
+            self._lock.release()
+
+    def set(self, key, value):
+        self._lock.acquire()
+        try:
+            self._data.pop(key, None)
+            self._data[key] = value
+            while len(self._data) > self.max_size:
+                self._data.popitem(last=False)
+        finally:
+            self._lock.release()
+
+    def delete(self, key):
+        self._lock.acquire()
+        try:
+            self._data.pop(key, None)
+        finally:
+            self._lock.release()
+
+    def clear(self):
+        self._lock.acquire()
+        try:
+            self._data.clear()
+        finally:
+            self._lock.release()
+
+    def items(self):
+        self._lock.acquire()
+        try:
+            return self._data.items()
+        finally:
+            self._lock.release()
+
+    def __len__(self):
+        return len(self._data)
+
+    def __contains__(self, key):
+        return key in self._data
+
+
+class InstanceCache(object):
+    """
+    Caches model instances keyed by the value of one of their fields,
+    for small vocabularies such as ``EntityType`` that are looked up
+    constantly but almost never change.
+
+    Call :meth:`connect` to invalidate entries from the ``post_save``
+    and ``post_delete`` signals. Changes made with ``QuerySet.update``
+    or by other processes are not seen until the entry is evicted or
+    :meth:`clear` is called.
+
+    Nothing is cached while a managed transaction has uncommitted
+    writes, since the rows read or inserted then may be rolled back.
+    """
+    def __init__(self, model, field, max_size=1000):
+        self.model = model
+        self.field = field
+        self._cache = LRUCache(max_size)
+
+    def get(self, value):
+        return self._cache.get(value)
+
+    def add(self, obj):
+        from django.db import router, transaction
+        using = router.db_for_write(self.model)
+        if transaction.is_managed(using=using) and \
+                transaction.is_dirty(using=using):
+            return
+        self._cache.set(getattr(obj, self.field), obj)
+
+    def clear(self):
+        self._cache.clear()
+
+    def get_or_create(self, value, defaults):
+        """
+        Return the instance whose field matches ``value``, consulting
+        the database (and creating the row from ``defaults``) only on
+        a cache miss. If the model has a ``DigestField`` of the field,
+        the database is queried through the digest. The field must be
+        unique, so that concurrent misses cannot create duplicates.
+        """
+        from djangocalais.fields import get_digest_field, url_digest
+        from djangocalais.upsert import get_or_insert
+        obj = self._cache.get(value)
+        if obj is None:
+            lookup = {self.field: value}
+            digest = get_digest_field(self.model, self.field)
+            if digest is not None:
+                # look long values up through their indexed digest
+                lookup = {digest.name: url_digest(value)}
+            kwargs = dict(defaults)
+            kwargs.setdefault(self.field, value)
+            obj, created = get_or_insert(self.model, self.model(**kwargs),
+                                         **lookup)
+            self.add(obj)
+        return obj
+
+    def invalidate(self, sender, instance, **kwargs):
+        """
+        Signal handler that drops ``instance`` from the cache, both
+        under its current field value and any value it was cached
+        under before being changed.
+        """
+        self._cache.delete(getattr(instance, self.field))
+        for key, obj in self._cache.items():
+            if obj.pk == instance.pk:
+                self._cache.delete(key)
+
+    def connect(self):
+        from django.db.models.signals import post_save, post_delete
+        uid = 'djangocalais.cache.%s' % self.model.__name__
+        post_save.connect(self.invalidate, sender=self.model,
+                          dispatch_uid=uid)
+        post_delete.connect(self.invalidate, sender=self.model,
+                            dispatch_uid=uid)
+
+
+class BaseResultCache(object):
+    """
+    Base class for caches of parsed OpenCalais results.
+
+    Results are keyed by the SHA-1 hash of the submitted text (the
+    ``externalID`` sent to Calais) together with the content type and
+    output format. Entries expire after ``timeout`` seconds and at most
+    ``max_entries`` are kept. Values are stored pickled, so callers are
+    free to modify the results they get back.
+    """
+    def __init__(self, timeout=86400, max_entries=1000):
+        self.timeout = timeout
+        self.max_entries = max_entries
+
+    def make_key(self, text_hash, content_type, output_format):
+        return hashlib.sha1('%s:%s:%s' % (
+            text_hash, content_type, output_format)).hexdigest()
+
+    def get(self, key):
+        raise NotImplementedError
+
+    def set(self, key, value):
+        raise NotImplementedError
+
+
+class MemoryResultCache(BaseResultCache):
+    """
+    Keeps results in the memory of the current process, discarding the
+    least recently used entry when ``max_entries`` is reached.
+    """
+    def __init__(self, timeout=86400, max_entries=1000):
+        super(MemoryResultCache, self).__init__(timeout, max_entries)
+        self._cache = LRUCache(max_entries)
+
+    def get(self, key):
+        entry = self._cache.get(key)
+        if entry is None:
+            return None
+        expires, data = entry
+        if expires < time.time():
+            self._cache.delete(key)
+            return None
+        return loads(data)
+
+    def set(self, key, value):
+        self._cache.set(key, (time.time() + self.timeout,
+                              dumps(value, HIGHEST_PROTOCOL)))
+
+
+class DjangoResultCache(BaseResultCache):
+    """
+    Stores results with Django's cache framework, so they can be
+    shared between processes. ``max_entries`` is not used; eviction is
+    left to the cache backend's own ``MAX_ENTRIES`` and culling
+    settings. ``backend`` names a configured cache other than the
+    default one.
+    """
+    def __init__(self, timeout=86400, max_entries=None, backend=None,
+                 key_prefix='djangocalais'):
+        super(DjangoResultCache, self).__init__(timeout, max_entries)
+        if backend is None:
+            from django.core.cache import cache
+        else:
+            from django.core.cache import get_cache
+            cache = get_cache(backend)
+        self._cache = cache
+        self.key_prefix = key_prefix
+
+    def get(self, key):
+        return self._cache.get('%s:%s' % (self.key_prefix, key))
+
+    def set(self, key, value):
+        self._cache.set('%s:%s' % (self.key_prefix, key), value,
+                        self.timeout)
+
+
+class FileResultCache(BaseResultCache):
+    """
+    Stores each result as a pickle in ``directory``. When the number
+    of files exceeds ``max_entries``, the oldest third are removed.
+    """
+    cull_fraction = 3
+
+    def __init__(self, directory, timeout=86400, max_entries=10000):
+        super(FileResultCache, self).__init__(timeout, max_entries)
+        self.directory = directory
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    def _path(self, key):
+        return os.path.join(self.directory, '%s.pickle' % key)
+
+    def get(self, key):
+        path = self._path(key)
+        try:
+            f = open(path, 'rb')
+        except IOError:
+            return None
+        try:
+            try:
+                expires, value = loads(f.read())
+            except Exception:
+                expires, value = 0, None
+        finally:
+            f.close()
+        if expires < time.time():
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            return None
+        return value
+
+    def set(self, key, value):
+        fd, tmp = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+        f = os.fdopen(fd, 'wb')
+        try:
+            f.write(dumps((time.time() + self.timeout, value),
+                          HIGHEST_PROTOCOL))
+        finally:
+            f.close()
+        os.rename(tmp, self._path(key))
+        self._cull()
+
+    def _cull(self):
+        names = [name for name in os.listdir(self.directory)
+                 if name.endswith('.pickle')]
+        if len(names) <= self.max_entries:
+            return
+        paths = [os.path.join(self.directory, name) for name in names]
+        paths.sort(key=lambda path: os.path.getmtime(path))
+        for path in paths[:max(len(paths) / self.cull_fraction,
+                               len(paths) - self.max_entries)]:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+
+_result_cache = None
+
+def get_result_cache():
+    """
+    Return the result cache configured by the ``CALAIS_RESULT_CACHE``
+    setting, or ``None`` if no cache is configured. The setting is the
+    dotted path of a result cache class, instantiated once per process
+    with the keyword arguments in ``CALAIS_RESULT_CACHE_OPTIONS``.
+    """
+    global _result_cache
+    if _result_cache is None:
+        from django.conf import settings
+        from django.utils.importlib import import_module
+        path = getattr(settings, 'CALAIS_RESULT_CACHE', None)
+        if not path:
+            return None
+        module, name = path.rsplit('.', 1)
+        cls = getattr(import_module(module), name)
+        options = getattr(settings, 'CALAIS_RESULT_CACHE_OPTIONS', {})
+        _result_cache = cls(**options)
+    return _result_cache
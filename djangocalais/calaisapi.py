@@ -8,17 +8,208 @@ This interface to OpenCalais's API supports GZIP results, uses urllib2
 openers to handle errors and timeouts, supports JSON, and returns
 everything as Python dictionaries.
 
-Requires cjson, which is available from:
-http://pypi.python.org/pypi/python-cjson
+JSON responses are decoded with the fastest library available: ujson,
+cjson (http://pypi.python.org/pypi/python-cjson), simplejson or the
+standard library's json module, in that order.
 '''
-import hashlib, StringIO
-import urllib, urllib2, gzip
+import codecs, hashlib, logging, random, re, socket, time, zlib
+import httplib, urllib, urllib2
+from email.utils import parsedate_tz, mktime_tz
 from django.conf import settings
-from djangocalais.parser import CalaisParser
+from djangocalais import metrics
+from djangocalais.parser import CalaisParser, CalaisRDFParser
+from djangocalais.pool import ConnectionPool
+from djangocalais.utils import parallel_map
 
 
 CALAIS_URL = 'http://api.opencalais.com/enlighten/rest/'
 
+log = logging.getLogger('djangocalais')
+
+# Responses that mean "try again later" rather than "this will never work"
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+def _find_json_decoder():
+    """
+    Return the decode function and error class of the fastest JSON
+    library that is installed.
+    """
+    try:
+	import ujson
+	return ujson.loads, ValueError
+    except ImportError:
+	pass
+    try:
+	import cjson
+	return cjson.decode, cjson.DecodeError
+    except ImportError:
+	pass
+    try:
+	import simplejson as json
+    except ImportError:
+	try:
+	    import json
+	except ImportError:
+	    from django.utils import simplejson as json
+    return json.loads, ValueError
+
+json_decode, JSONDecodeError = _find_json_decoder()
+
+# Bytes read from a socket (or produced by gzip) in one step
+CHUNK_SIZE = 64 * 1024
+
+class ResponseTooLarge(ValueError):
+    pass
+
+def iter_body(f, gzipped=False, chunk_size=CHUNK_SIZE):
+    """
+    Read the body of the response f a chunk at a time, decompressing
+    gzip data as it arrives rather than buffering the whole body first.
+    """
+    if gzipped:
+	# 16 + MAX_WBITS tells zlib to expect a gzip header
+	decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+    else:
+	decompressor = None
+    timed = gzipped and metrics.enabled()
+    elapsed = 0
+    while True:
+	chunk = f.read(chunk_size)
+	if not chunk:
+	    break
+	if decompressor is None:
+	    yield chunk
+	    continue
+	while chunk:
+	    if timed:
+		started = time.time()
+	    data = decompressor.decompress(chunk, chunk_size)
+	    chunk = decompressor.unconsumed_tail
+	    if timed:
+		elapsed += time.time() - started
+	    if data:
+		yield data
+    if decompressor is not None:
+	data = decompressor.flush()
+	if timed:
+	    metrics.timing('calais.gunzip', elapsed)
+	if data:
+	    yield data
+
+def read_body(f, gzipped=False, max_size=None):
+    """
+    Return the (decompressed) body of the response f, raising
+    ResponseTooLarge as soon as it grows beyond max_size bytes.
+    """
+    parts, size = [], 0
+    for data in iter_body(f, gzipped):
+	size += len(data)
+	if max_size is not None and size > max_size:
+	    raise ResponseTooLarge('Response body exceeds %d bytes' % max_size)
+	parts.append(data)
+    metrics.incr('calais.response_bytes', size)
+    return ''.join(parts)
+
+def hash_text(text, encoding='utf8'):
+    """
+    Return the SHA-1 hex digest of text, as sent to Calais in the
+    externalID parameter.
+    """
+    h = hashlib.sha1()
+    h.update(text.encode(encoding))
+    return h.hexdigest()
+
+# Places to split long documents, most preferred first
+CHUNK_BREAKS = (re.compile(r'\n\s*\n'), re.compile(r'(?<=[.!?])\s+'),
+                re.compile(r'\s+'))
+
+def split_text(text, size_limit):
+    """
+    Split text into (offset, chunk) pairs of at most size_limit
+    characters, breaking between paragraphs where possible, otherwise
+    between sentences or words.
+    """
+    chunks = []
+    start = 0
+    while len(text) - start > size_limit:
+	end = start + size_limit
+	chunk_end = next_start = end
+	for pattern in CHUNK_BREAKS:
+	    last = None
+	    for match in pattern.finditer(text, start, end + 1):
+		last = match
+	    if last is not None and start < last.start() <= end:
+		chunk_end, next_start = last.start(), last.end()
+		break
+	chunks.append((start, text[start:chunk_end]))
+	start = next_start
+    chunks.append((start, text[start:]))
+    return chunks
+
+# Result groups keyed by type and then by URI, and those keyed by a
+# URI of the document, with the field naming the same item in every one
+TYPED_GROUPS = ('entities', 'relations')
+UNTYPED_GROUPS = {'socialTag': 'socialTag', 'topics': 'category'}
+
+def _merge_item(items, uri, data, offset, weight):
+    instances = []
+    for instance in data.get('instances', []):
+	if 'offset' in instance:
+	    instance = dict(instance, offset=instance['offset'] + offset)
+	instances.append(instance)
+    item = items.get(uri)
+    if item is None:
+	item = items[uri] = dict(data)
+	if 'instances' in data:
+	    item['instances'] = instances
+	if 'relevance' in data:
+	    item['relevance'] = data['relevance'] * weight
+	return
+    if instances:
+	item.setdefault('instances', []).extend(instances)
+    if 'relevance' in data:
+	item['relevance'] = item.get('relevance', 0) + data['relevance'] * weight
+    if 'importance' in data and 'importance' in item:
+	# 1 is the most important
+	item['importance'] = min(item['importance'], data['importance'])
+    if 'score' in data and 'score' in item:
+	item['score'] = max(item['score'], data['score'])
+
+def merge_results(results, offsets, lengths):
+    """
+    Merge the JSON results of analyzing consecutive chunks of a document
+    into a single result for the whole document.
+
+    Items found in several chunks are merged by URI (social tags by their
+    socialTag and topics by their category, since their own URIs differ
+    for every chunk): their instances are concatenated, with offsets shifted to positions in the document,
+    their relevance is the average over all chunks weighted by chunk
+    length (counting chunks without the item as 0), social tags keep
+    their highest importance and topics their highest score. Anything
+    else is taken from the first chunk that has it.
+    """
+    merged = {}
+    # the key each untyped item was first merged under
+    keys = dict([(group, {}) for group in UNTYPED_GROUPS])
+    total = float(sum(lengths)) or 1.0
+    for result, offset, length in zip(results, offsets, lengths):
+	weight = length / total
+	for group, value in result.items():
+	    if group in TYPED_GROUPS:
+		for item_type, items in value.items():
+		    target = merged.setdefault(group, {}).setdefault(item_type, {})
+		    for uri, data in items.items():
+			_merge_item(target, uri, data, offset, weight)
+	    elif group in UNTYPED_GROUPS:
+		target = merged.setdefault(group, {})
+		for uri, data in value.items():
+		    key = keys[group].setdefault(
+			data.get(UNTYPED_GROUPS[group], uri), uri)
+		    _merge_item(target, key, data, offset, weight)
+	    else:
+		merged.setdefault(group, value)
+    return merged
+
 class DefaultErrorHandler(urllib2.HTTPDefaultErrorHandler):
     def http_error_default(self, req, fp, code, msg, headers):
 	result = urllib2.HTTPError(
@@ -46,23 +237,57 @@ class OpenCalais:
 <c:processingDirectives c:contentType="%s" c:outputFormat="%s" c:calculatedRelevanceScore="true" c:enableMetadataType="SocialTags">
 </c:processingDirectives><c:userDirectives c:allowDistribution="%s" c:allowSearch="%s" c:externalID="%s" c:submitter="%s"></c:userDirectives><c:externalMetadata></c:externalMetadata></c:params>
 """
+    REQUEST_HEADERS = {'User-Agent': 'Python OpenCalaisAPI',
+		       'Accept-encoding': 'gzip',
+		       'Content-Type': 'application/x-www-form-urlencoded'}
     
     def __init__(self, api_key, submitter='Generic django-calais script',
-		 allow_distribution=False, allow_search=False):
+		 allow_distribution=False, allow_search=False, cache=None,
+		 pool_size=4, timeout=60, rate_limiter=None, max_retries=3,
+		 deadline=300, max_response_size=20 * 1024 * 1024, url=CALAIS_URL):
 	"""
 	Construct an OpenCalais object using a provided API key.
 
 	Api_key is required.
+
+	Requests to the API reuse keep-alive connections from a pool
+	holding up to pool_size connections, so a single OpenCalais object
+	should be shared between calls (and threads) where possible.
+
+	Cache is an optional result cache (see djangocalais.cache). When
+	given, analyzing text that has already been analyzed with the same
+	content type and output format returns the cached result without
+	contacting OpenCalais.
+
+	Timeouts, connection errors and 429/5xx responses are retried up to
+	max_retries times with exponential backoff and jitter, honouring
+	any Retry-After header, as long as the whole call fits within
+	deadline seconds. Rate_limiter is an optional
+	djangocalais.ratelimit.RateLimiter that every request must pass.
+
+	Responses are decompressed as they are read, and a response whose
+	body grows beyond max_response_size bytes is abandoned.
+
+	Url is the API endpoint, which only needs changing to point the
+	client at a stand-in server such as djangocalais.fakeserver.
 	"""
 	self.api_key = api_key
 	self.submitter = submitter
 	self.allow_distribution = allow_distribution
 	self.allow_search = allow_search
+	self.cache = cache
+	self.pool = self._make_pool(pool_size, timeout)
+	self.rate_limiter = rate_limiter
+	self.max_retries = max_retries
+	self.deadline = deadline
+	self.max_response_size = max_response_size
+	self.url = url
+
+    def _make_pool(self, pool_size, timeout):
+	return ConnectionPool(max_size=pool_size, timeout=timeout)
 
     def _hash_text(self, text, encoding='utf8'):
-	h = hashlib.sha1()
-	h.update(text.encode(encoding))
-	return h.hexdigest()
+	return hash_text(text, encoding)
 
     def _resolveReferences(self, flatdb):
 	for element in flatdb.keys():
@@ -91,6 +316,28 @@ class OpenCalais:
 		hdb[element] = flatdb[element]
 	return hdb
     
+    def _buildHierarchy(self, flatdb):
+	"""
+	Resolve references and group elements by type in a single pass over
+	flatdb; equivalent to _createHierarchy(_resolveReferences(flatdb)).
+	"""
+	hdb = {}
+	for element, data in flatdb.iteritems():
+	    for attribute, val in data.items():
+		if isinstance(val, basestring) and val in flatdb:
+		    data[attribute] = flatdb[val]
+	    elementGroup = data.get('_typeGroup', None)
+	    if elementGroup:
+		group = hdb.setdefault(elementGroup, {})
+		elementType = data.get('_type', None)
+		if elementType:
+		    group.setdefault(elementType, {})[element] = data
+		else:
+		    group[element] = data
+	    else:
+		hdb[element] = data
+	return hdb
+    
     def analyze(self, text, content_type='text/html',
                 output_format='application/json', encoding='utf8',
                 size_limit=100000, raw=False):
@@ -112,69 +359,189 @@ class OpenCalais:
 	    text = text[:size_limit]
 	
 	externalID = self._hash_text(text, encoding=encoding)
+	if self.cache is not None:
+	    cache_key = self.cache.make_key(externalID, content_type,
+					    output_format)
+	    cached = self.cache.get(cache_key)
+	    if cached is not None:
+		return cached
+	param = self._encode_params(text, content_type, output_format,
+				    externalID, encoding)
+	try:
+	    f, data = self._post(param)
+	except (IOError, httplib.HTTPException), e:
+	    metrics.incr('calais.errors')
+	    log.error('Failed to reach the Calais server: %s', e)
+	    return {}
+	except Exception, e:
+	    metrics.incr('calais.errors')
+	    log.exception('Unexpected exception: %s', e)
+	    return {}
+	else:
+	    if f.status != 200:
+		metrics.incr('calais.errors')
+		log.error("The Calais server couldn't fulfill the request. "
+			  "Error code: %s", f.status)
+		return {}
+	    
+	    result = self.construct_response(data, output_format)
+	    if self.cache is not None and result:
+		self.cache.set(cache_key, result)
+	    return result
+
+    def analyze_chunked(self, text, content_type='text/txt',
+                        encoding='utf8', size_limit=100000, workers=4):
+	"""
+	Analyze text of any length. Text longer than size_limit is split
+	between paragraphs (or failing that, sentences or words) into
+	chunks that are analyzed up to workers at a time, and their results
+	are combined with merge_results, so that instance offsets refer to
+	the whole text. Results are always JSON.
+
+	Splitting is only safe for plain text; markup may be cut in half.
+	If any chunk cannot be analyzed, {} is returned.
+	"""
+	if len(text) <= size_limit:
+	    return self.analyze(text, content_type=content_type,
+				encoding=encoding, size_limit=size_limit)
+	chunks = split_text(text, size_limit)
+	results = parallel_map(
+	    lambda (offset, chunk): self.analyze(
+		chunk, content_type=content_type, encoding=encoding,
+		size_limit=size_limit),
+	    chunks, workers)
+	if not all(results):
+	    return {}
+	return merge_results(results, [offset for offset, chunk in chunks],
+			     [len(chunk) for offset, chunk in chunks])
+
+    RETRY_BACKOFF = 1.0
+    RETRY_MAX_BACKOFF = 60.0
+
+    def _post(self, param):
+	"""
+	Post param to the Calais API and return the response with its body,
+	retrying as described in __init__. The last error is raised, or the
+	last response returned, once no further attempt is possible.
+	"""
+	deadline = None
+	if self.deadline is not None:
+	    deadline = time.time() + self.deadline
+	metrics.incr('calais.request_bytes', len(param))
+	attempt = 0
+	while True:
+	    if self.rate_limiter is not None:
+		if not self.rate_limiter.acquire(deadline):
+		    raise socket.timeout('Deadline passed waiting for the '
+					 'rate limiter')
+	    error = response = None
+	    try:
+		try:
+		    started = metrics.start()
+		    f = self.pool.urlopen('POST', self.url, param,
+					  self.REQUEST_HEADERS)
+		    try:
+			gzipped = f.getheader('content-encoding', '') == 'gzip'
+			response = f, read_body(f, gzipped,
+						self.max_response_size)
+		    finally:
+			f.close()
+		    metrics.stop('calais.http', started)
+		except (IOError, httplib.HTTPException), e:
+		    error = e
+	    finally:
+		if self.rate_limiter is not None:
+		    self.rate_limiter.release()
+	    if response is not None and f.status not in RETRY_STATUSES:
+		return response
+	    if attempt >= self.max_retries:
+		break
+	    delay = self._backoff(attempt)
+	    if response is not None:
+		delay = self._retry_after(f) or delay
+		if f.status == 429 and self.rate_limiter is not None:
+		    # slow down every thread sharing the limiter, not just this one
+		    self.rate_limiter.pause(delay)
+	    if deadline is not None and time.time() + delay > deadline:
+		break
+	    metrics.incr('calais.retries')
+	    time.sleep(delay)
+	    attempt += 1
+	if error is not None:
+	    raise error
+	return response
+
+    def _backoff(self, attempt):
+	# exponential backoff with "full jitter"
+	return random.uniform(0, min(self.RETRY_MAX_BACKOFF,
+				     self.RETRY_BACKOFF * 2 ** attempt))
+
+    def _retry_after(self, f):
+	value = f.getheader('retry-after')
+	if not value:
+	    return None
+	try:
+	    return max(0, int(value))
+	except ValueError:
+	    date = parsedate_tz(value)
+	    if date is None:
+		return None
+	    return max(0, mktime_tz(date) - time.time())
+
+    def _encode_params(self, text, content_type, output_format, externalID,
+		       encoding='utf8'):
 	paramsXML = self.INPUT_PARAMS % (
 	    content_type, output_format,
 	    str(self.allow_distribution).lower(),
 	    str(self.allow_search).lower(), externalID,
 	    self.submitter)
-	param = urllib.urlencode({
+	return urllib.urlencode({
 		'licenseID': self.api_key,
 		'content': text.encode(encoding),
 		'paramsXML': paramsXML
 		})
-	
-	request = urllib2.Request(CALAIS_URL, param)
-	opener = urllib2.build_opener(DefaultErrorHandler())
-	request.add_header('User-Agent', 'Python OpenCalaisAPI')
-	request.add_header('Accept-encoding', 'gzip')
-	try:
-	    f = opener.open(request)
-	except IOError, e:
-	    if hasattr(e, 'reason'):
-		print ">>> calaisapi.py failed to reach the Calais server."
-		print ">>> Reason: ", e.reason
-	    elif hasattr(e, 'code'):
-		print ">>> The server couldn't fulfill the request."
-		print ">>> Error code: ", e.code
-	    return {}
-	except Exception, e:
-	    print ">>> Unexpected exception: %s" % e
-	    return {}
+
+    def construct_response(self, data, output_format):
+	if output_format == 'application/json':
+	    return self.construct_json_response(data)
 	else:
-	    data = f.read()
-	    if f.headers.get('content-encoding', '') == 'gzip':
-		data = gzip.GzipFile(fileobj=StringIO.StringIO(data)).read()
-	    f.close()
-	    
-	    if output_format == 'application/json':
-		return self.construct_json_response(data)
-	    else:
-		return self.construct_rdf_response(data)
+	    return self.construct_rdf_response(data)
 
-    def construct_rdf_response(self, data):
-	from xml.dom import minidom
-	dom = minidom.parseString(data)
-	rdfdoc = dom.childNodes[2]
-	cp=CalaisParser(rdfdoc)
-	return cp.results
+    def construct_rdf_response(self, data, entity_callback=None):
+	"""
+	Parse an RDF response in a single streaming pass. Entity_callback,
+	if given, is called with the URI and data of each entity as soon as
+	it has been parsed (see djangocalais.parser.CalaisRDFParser).
+	"""
+	started = metrics.start()
+	results = CalaisRDFParser(data, entity_callback).results
+	metrics.stop('calais.decode.rdf', started)
+	return results
 
     def construct_json_response(self, data):
-	import cjson
+	started = metrics.start()
 	try:
-	    intermediate_json = cjson.decode(data)
-	except cjson.DecodeError:
-	    print ">>> OpenCalais Error: %s" % data
+	    intermediate_json = json_decode(data)
+	except JSONDecodeError:
+	    metrics.incr('calais.errors')
+	    log.error('OpenCalais Error: %s', data)
 	    return {}
-	json_data = self._resolveReferences(intermediate_json)
-	return self._createHierarchy(json_data)
+	metrics.stop('calais.decode.json', started)
+	started = metrics.start()
+	results = self._buildHierarchy(intermediate_json)
+	metrics.stop('calais.hierarchy', started)
+	return results
 
     def analyze_url(self, url, content_type='text/html',
 		    output_format='application/json',
-		    encoding='utf8'):
+		    encoding='utf8', size_limit=100000):
 	"""
 	Retrieve a document from the given URL and submit it to OpenCalais for
 	semantic analysis. Defaults to 'text/html' content-type.
 
+	Only as much of the document as will be submitted (size_limit
+	characters) is downloaded.
+
         `application/json` output format will automatically translate to Python
         dictionaries.        
 	"""
@@ -186,22 +553,29 @@ class OpenCalais:
 	try:
 	    f = opener.open(request)
 	except IOError, e:
+	    metrics.incr('calais.errors')
 	    if hasattr(e, 'reason'):
-		print ">>> analyze_url() failed to load: %s." % url
-		print ">>> Reason: ", e.reason
+		log.error('analyze_url() failed to load %s: %s', url, e.reason)
 	    elif hasattr(e, 'code'):
-		print ">>> analyze_url() failed"
-		print ">>> The server couldn't fulfill the request."
-		print ">>> Error code: ", e.code
+		log.error("analyze_url() failed: the server couldn't fulfill "
+			  "the request. Error code: %s", e.code)
 	    return {}
         except ValueError:
             return {}
 	else:
-	    data = f.read()
-	    if f.headers.get('content-encoding', '') == 'gzip':
-		data = gzip.GzipFile(fileobj=StringIO.StringIO(data)).read()
-	    f.close()
-	    content = data.decode(encoding, 'ignore')
+	    gzipped = f.headers.get('content-encoding', '') == 'gzip'
+	    decoder = codecs.getincrementaldecoder(encoding)('ignore')
+	    parts, length = [], 0
+	    try:
+		for data in iter_body(f, gzipped):
+		    text = decoder.decode(data)
+		    parts.append(text)
+		    length += len(text)
+		    if length >= size_limit:
+			break
+	    finally:
+		f.close()
+	    content = u''.join(parts)[:size_limit]
 	    return self.analyze(content, content_type=content_type,
 				output_format=output_format,
-				encoding=encoding)
+				encoding=encoding, size_limit=size_limit)
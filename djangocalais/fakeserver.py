@@ -0,0 +1,125 @@
+"""
+A local stand-in for the OpenCalais API.
+
+``FakeCalaisServer`` answers every analysis request with a recorded
+response (JSON or RDF, depending on the requested output format),
+gzipped if the client accepts it, after an optional delay and with an
+optional share of failed requests. Point a client at it with the
+``url`` argument of ``OpenCalais``::
+
+    server = FakeCalaisServer(json_response=data, latency=0.2).start()
+    api = OpenCalais('key', url=server.url)
+    ...
+    server.stop()
+
+GET requests (as made by ``analyze_url``) receive ``page``.
+"""
+import BaseHTTPServer, SocketServer, cgi, gzip, random, re, threading, time
+from cStringIO import StringIO
+
+OUTPUT_FORMAT = re.compile(r'c:outputFormat="([^"]+)"')
+
+
+class _Server(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def handle_error(self, request, client_address):
+        # clients dropping keep-alive connections are not errors here
+        pass
+
+
+class _Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, *args):
+        pass
+
+    def do_POST(self):
+        length = int(self.headers.get('content-length', 0))
+        params = cgi.parse_qs(self.rfile.read(length))
+        match = OUTPUT_FORMAT.search(params.get('paramsXML', [''])[0])
+        output_format = match and match.group(1) or 'application/json'
+        fake = self.server.fake
+        if output_format == 'application/json':
+            self.respond(fake.json_response, 'application/json')
+        else:
+            self.respond(fake.rdf_response, 'text/xml')
+
+    def do_GET(self):
+        self.respond(self.server.fake.page, 'text/html')
+
+    def respond(self, body, content_type):
+        fake = self.server.fake
+        fake._count()
+        if fake.latency:
+            time.sleep(fake.latency)
+        if fake.error_rate and fake.random.random() < fake.error_rate:
+            body = 'Service unavailable'
+            self.send_response(fake.error_status)
+        else:
+            self.send_response(200)
+            if fake.gzip and \
+                    'gzip' in self.headers.get('accept-encoding', ''):
+                body = _gzip(body)
+                self.send_header('Content-Encoding', 'gzip')
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+def _gzip(data):
+    buf = StringIO()
+    f = gzip.GzipFile(fileobj=buf, mode='wb')
+    f.write(data)
+    f.close()
+    return buf.getvalue()
+
+
+class FakeCalaisServer(object):
+    """
+    A threaded HTTP server that replays ``json_response`` or
+    ``rdf_response`` (both strings) to analysis requests. Each response
+    is delayed by ``latency`` seconds; a fraction ``error_rate`` of
+    requests fail with ``error_status`` instead. Responses are only
+    gzipped when ``gzip`` is true. ``port`` 0 picks a free port.
+    """
+    def __init__(self, json_response='{}', rdf_response='', page='',
+                 latency=0, error_rate=0, error_status=503, gzip=True,
+                 host='127.0.0.1', port=0, seed=None):
+        self.json_response = json_response
+        self.rdf_response = rdf_response
+        self.page = page
+        self.latency = latency
+        self.error_rate = error_rate
+        self.error_status = error_status
+        self.gzip = gzip
+        self.random = random.Random(seed)
+        self.requests = 0
+        self._lock = threading.Lock()
+        self._server = _Server((host, port), _Handler)
+        self._server.fake = self
+        self._thread = None
+
+    def _count(self):
+        self._lock.acquire()
+        try:
+            self.requests += 1
+        finally:
+            self._lock.release()
+
+    @property
+    def url(self):
+        host, port = self._server.server_address
+        return 'http://%s:%d/enlighten/rest/' % (host, port)
+
+    def start(self):
+        self._thread = threading.Thread(target=self._server.serve_forever)
+        self._thread.setDaemon(True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
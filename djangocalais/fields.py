@@ -1,13 +1,28 @@
+import hashlib
 from copy import deepcopy
 from base64 import b64encode, b64decode
+from collections import OrderedDict
 from zlib import compress, decompress
 try:
     from cPickle import loads, dumps
 except ImportError:
     from pickle import loads, dumps
+try:
+    import simplejson as json
+except ImportError:
+    import json
 
+from django.conf import settings
 from django.db import models
-from django.utils.encoding import force_unicode
+from django.utils.encoding import force_unicode, smart_str
+from djangocalais import metrics
+
+# zlib's default compression level, used for ``compress=True``
+DEFAULT_COMPRESS_LEVEL = 6
+
+# Column types for ``binary=True``, by database engine
+BINARY_COLUMN_TYPES = (('postgresql', 'bytea'), ('mysql', 'longblob'),
+                       ('oracle', 'BLOB'))
 
 class PickledObject(str):
     """
@@ -37,7 +52,8 @@ def dbsafe_encode(value, compress_object=False):
     if not compress_object:
         value = b64encode(dumps(deepcopy(value)))
     else:
-        value = b64encode(compress(dumps(deepcopy(value))))
+        value = b64encode(compress(dumps(deepcopy(value)),
+                                   _compress_level(compress_object)))
     return PickledObject(value)
 
 def dbsafe_decode(value, compress_object=False):
@@ -47,11 +63,153 @@ def dbsafe_decode(value, compress_object=False):
         value = loads(decompress(b64decode(value)))
     return value
 
+def _compress_level(compress_object):
+    if compress_object is True:
+        return DEFAULT_COMPRESS_LEVEL
+    return compress_object
+
+def _canonical(value):
+    """
+    Copy ``value`` with every dictionary replaced by one whose keys are
+    sorted, so that msgpack output does not depend on insertion order.
+    """
+    if isinstance(value, dict):
+        return OrderedDict([(k, _canonical(value[k]))
+                            for k in sorted(value.keys())])
+    if isinstance(value, (list, tuple)):
+        return [_canonical(v) for v in value]
+    return value
+
+def _json_dumps(value, protocol):
+    return json.dumps(value, sort_keys=True, separators=(',', ':'))
+
+def _json_loads(data):
+    return json.loads(data)
+
+def _msgpack_dumps(value, protocol):
+    import msgpack
+    return msgpack.packb(_canonical(value), use_bin_type=True)
+
+def _msgpack_loads(data):
+    import msgpack
+    return msgpack.unpackb(data, raw=False)
+
+def _pickle_dumps(value, protocol):
+    return dumps(deepcopy(value), protocol)
+
+# Serializers other than the legacy base64-encoded pickle. JSON and
+# msgpack output is deterministic, so unlike pickle no deepcopy() is
+# needed to make lookups work. Both turn tuples into lists.
+CODECS = {
+    'json': (_json_dumps, _json_loads),
+    'msgpack': (_msgpack_dumps, _msgpack_loads),
+    'pickle': (_pickle_dumps, loads),
+}
+
+def encode_value(value, codec='pickle', compress_object=False, binary=False,
+                 protocol=2):
+    """
+    Serialize ``value`` for storage. Text values are prefixed with the
+    codec name (and ``z`` if compressed), except for uncompressed or
+    compressed pickles in text columns, which keep the original
+    ``dbsafe_encode`` format. Binary values carry a short header
+    starting with a NUL byte, which can never begin a text value.
+    """
+    if codec == 'pickle' and not binary:
+        return dbsafe_encode(value, compress_object)
+    data = CODECS[codec][0](value, protocol)
+    tag = codec
+    if compress_object:
+        data = compress(data, _compress_level(compress_object))
+        tag += 'z'
+    if binary:
+        return '\x00%s:%s' % (tag, data)
+    if tag != 'json':
+        data = b64encode(data)
+    return PickledObject('%s:%s' % (tag, data))
+
+def decode_value(value, compress_object=False):
+    """
+    Reverse ``encode_value``, whatever codec and compression the value
+    was written with. Anything without a codec prefix is decoded as a
+    legacy ``dbsafe_encode`` value.
+    """
+    if isinstance(value, buffer):
+        value = str(value)
+    binary = value.startswith('\x00')
+    if binary:
+        value = value[1:]
+    tag, sep, data = value.partition(':')
+    compressed = tag.endswith('z')
+    codec = compressed and tag[:-1] or tag
+    if not sep or codec not in CODECS:
+        return dbsafe_decode(value, compress_object)
+    if not binary and tag != 'json':
+        data = b64decode(data)
+    if compressed:
+        data = decompress(data)
+    return CODECS[codec][1](data)
+
+class _Encoded(object):
+    """
+    Holds a value as it was loaded from the database, until a lazy
+    ``PickledObjectField`` is first read.
+    """
+    __slots__ = ('value',)
+
+    def __init__(self, value):
+        self.value = value
+
+    def __reduce__(self):
+        # slots need protocol 2, and buffers cannot be pickled at all
+        value = self.value
+        if isinstance(value, buffer):
+            value = str(value)
+        return _Encoded, (value,)
+
+class PickledObjectDescriptor(object):
+    """
+    Attribute descriptor for ``PickledObjectField``. Like the one that
+    ``SubfieldBase`` installs, it runs ``to_python`` on every value
+    assigned. For ``lazy`` fields, encoded values are kept as they are
+    and only decoded (once) when the attribute is first read.
+    """
+    def __init__(self, field):
+        self.field = field
+
+    def __get__(self, obj, type=None):
+        if obj is None:
+            raise AttributeError('Can only be accessed via an instance.')
+        value = obj.__dict__[self.field.name]
+        if isinstance(value, _Encoded):
+            value = self.field.to_python(value.value)
+            obj.__dict__[self.field.name] = value
+        return value
+
+    def __set__(self, obj, value):
+        if self.field.lazy and isinstance(value, (basestring, buffer)):
+            obj.__dict__[self.field.name] = _Encoded(value)
+        else:
+            obj.__dict__[self.field.name] = self.field.to_python(value)
+
 class PickledObjectField(models.Field):
     """
     A field that will accept *any* python object and store it in the
     database. PickledObjectField will optionally compress it's values if
-    declared with the keyword argument ``compress=True``.
+    declared with the keyword argument ``compress=True``, or with a zlib
+    compression level such as ``compress=9``.
+
+    Values are pickled unless another ``codec`` is given: ``'json'`` or
+    ``'msgpack'`` (which requires the msgpack library) are faster,
+    smaller and deterministic, but only handle JSON-like data. With
+    ``binary=True`` values are stored in a native binary column without
+    base64 encoding. Values written with any codec, including rows
+    stored before these options existed, can always be read back.
+
+    With ``lazy=True`` values loaded from the database are only decoded
+    when the attribute is first accessed, so rows whose value is never
+    read cost nothing to load and are saved again without re-encoding.
+    A string assigned to a lazy field is taken to be an encoded value.
     
     Does not actually encode and compress ``None`` objects (although you
     can still do lookups using None). This way, it is still possible to
@@ -60,15 +218,29 @@ class PickledObjectField(models.Field):
     None values since they aren't pickled and encoded.
     
     """
-    __metaclass__ = models.SubfieldBase
-    
     def __init__(self, *args, **kwargs):
+        self.lazy = kwargs.pop('lazy', False)
         self.compress = kwargs.pop('compress', False)
         self.protocol = kwargs.pop('protocol', 2)
+        self.codec = kwargs.pop('codec', 'pickle')
+        self.binary = kwargs.pop('binary', False)
+        if self.codec not in CODECS:
+            raise ValueError('Unknown codec: %s' % self.codec)
         kwargs.setdefault('null', True)
         kwargs.setdefault('editable', False)
         super(PickledObjectField, self).__init__(*args, **kwargs)
     
+    def contribute_to_class(self, cls, name):
+        super(PickledObjectField, self).contribute_to_class(cls, name)
+        setattr(cls, self.name, PickledObjectDescriptor(self))
+
+    def pre_save(self, model_instance, add):
+        value = model_instance.__dict__.get(self.attname)
+        if isinstance(value, _Encoded):
+            # never decoded, so store it exactly as it was loaded
+            return PickledObject(value.value)
+        return super(PickledObjectField, self).pre_save(model_instance, add)
+
     def get_default(self):
         """
         Returns the default value for this field.
@@ -99,13 +271,16 @@ class PickledObjectField(models.Field):
         
         """
         if value is not None:
+            started = metrics.start()
             try:
-                value = dbsafe_decode(value, self.compress)
+                value = decode_value(value, self.compress)
             except:
                 # If the value is a definite pickle; and an error is raised in
                 # de-pickling it should be allowed to propogate.
                 if isinstance(value, PickledObject):
                     raise
+            else:
+                metrics.stop('calais.unpickle', started)
         return value
 
     def get_db_prep_value(self, value):
@@ -119,22 +294,49 @@ class PickledObjectField(models.Field):
         a different string. 
         
         """
-        if value is not None and not isinstance(value, PickledObject):
+        if isinstance(value, PickledObject):
+            if self.binary:
+                value = buffer(value)
+        elif value is not None:
+            started = metrics.start()
             # We call force_unicode here explicitly, so that the encoded string
             # isn't rejected by the postgresql_psycopg2 backend. Alternatively,
             # we could have just registered PickledObject with the psycopg
             # marshaller (telling it to store it like it would a string), but
             # since both of these methods result in the same value being stored,
             # doing things this way is much easier.
-            value = force_unicode(dbsafe_encode(value, self.compress))
+            if self.binary:
+                value = buffer(encode_value(value, self.codec, self.compress,
+                                            True, self.protocol))
+            else:
+                value = force_unicode(encode_value(value, self.codec,
+                                                   self.compress))
+            metrics.stop('calais.pickle', started)
         return value
 
     def value_to_string(self, obj):
+        # Serialized data is always text, even for binary fields
         value = self._get_val_from_obj(obj)
-        return self.get_db_prep_value(value)
+        if value is None or isinstance(value, PickledObject):
+            return value
+        return force_unicode(encode_value(value, self.codec, self.compress))
 
     def get_internal_type(self): 
         return 'TextField'
+
+    def db_type(self, connection=None):
+        if not self.binary:
+            if connection is None:
+                return super(PickledObjectField, self).db_type()
+            return super(PickledObjectField, self).db_type(connection=connection)
+        if connection is not None:
+            engine = connection.settings_dict['ENGINE']
+        else:
+            engine = settings.DATABASE_ENGINE
+        for name, column_type in BINARY_COLUMN_TYPES:
+            if name in engine:
+                return column_type
+        return 'BLOB'
     
     def get_db_prep_lookup(self, lookup_type, value):
         if lookup_type not in ['exact', 'in', 'isnull']:
@@ -142,3 +344,50 @@ class PickledObjectField(models.Field):
         # The Field model already calls get_db_prep_value before doing the
         # actual lookup, so all we need to do is limit the lookup types.
         return super(PickledObjectField, self).get_db_prep_lookup(lookup_type, value)
+
+
+def url_digest(value):
+    """
+    Return the 40 character SHA-1 hex digest of ``value``.
+    """
+    return hashlib.sha1(smart_str(value)).hexdigest()
+
+def get_digest_field(model, source):
+    """
+    Return the ``DigestField`` of ``model`` that digests the field
+    named ``source``, or ``None`` if it has none.
+    """
+    for field in model._meta.fields:
+        if isinstance(field, DigestField) and field.source == source:
+            return field
+    return None
+
+class DigestField(models.CharField):
+    """
+    A fixed-width digest of another field of the same model, filled in
+    whenever the object is saved (including by ``bulk_create``). Long
+    values such as Calais URIs can then be looked up through a compact
+    index on this column instead of a scan of the original one::
+
+        urlhash = models.TextField()
+        urldigest = DigestField('urlhash', unique=True)
+
+        Entity.objects.get(urldigest=url_digest(uri))
+
+    The column allows ``NULL`` so that it can be added to tables with
+    existing rows and backfilled afterwards.
+    """
+    def __init__(self, source, *args, **kwargs):
+        self.source = source
+        kwargs['max_length'] = 40
+        kwargs.setdefault('editable', False)
+        kwargs.setdefault('null', True)
+        kwargs.setdefault('blank', True)
+        super(DigestField, self).__init__(*args, **kwargs)
+
+    def pre_save(self, model_instance, add):
+        value = getattr(model_instance, self.source)
+        if value is not None:
+            value = url_digest(value)
+        setattr(model_instance, self.attname, value)
+        return value
@@ -0,0 +1,49 @@
+from optparse import make_option
+from django.core.management.base import BaseCommand, CommandError
+from django.db.models import get_model
+from djangocalais.models import CalaisDocument
+
+
+class Command(BaseCommand):
+    args = '<app_label.ModelName>'
+    help = ('Analyze every object of a model with OpenCalais, using the '
+            'model\'s calais_content_fields. Progress can be checkpointed '
+            'to a file so that an interrupted run resumes where it stopped.')
+    option_list = BaseCommand.option_list + (
+        make_option('--batch-size', dest='batch_size', type='int',
+                    default=100,
+                    help='Number of objects to read per query.'),
+        make_option('--workers', dest='workers', type='int', default=4,
+                    help='Number of objects to analyze in parallel.'),
+        make_option('--checkpoint', dest='checkpoint', default=None,
+                    help='File recording the last analyzed primary key.'),
+        make_option('--force', action='store_true', dest='force',
+                    default=False,
+                    help='Re-analyze fields that have not changed.'),
+    )
+
+    def handle(self, *args, **options):
+        if len(args) != 1 or '.' not in args[0]:
+            raise CommandError('Usage: calais_analyze %s' % self.args)
+        app_label, model_name = args[0].split('.', 1)
+        model = get_model(app_label, model_name)
+        if model is None:
+            raise CommandError('Unknown model: %s' % args[0])
+        if not hasattr(model, 'calais_content_fields'):
+            raise CommandError('%s has no calais_content_fields attribute.'
+                               % args[0])
+        verbosity = int(options.get('verbosity', 1))
+
+        def progress(stats):
+            if verbosity > 0:
+                self.stdout.write('%s\n' % unicode(stats))
+
+        stats = CalaisDocument.objects.analyze_queryset(
+            model._default_manager.all(),
+            batch_size=options['batch_size'],
+            workers=options['workers'],
+            checkpoint=options['checkpoint'],
+            progress=progress,
+            force=options['force'])
+        if verbosity > 0:
+            self.stdout.write('Finished: %s\n' % unicode(stats))
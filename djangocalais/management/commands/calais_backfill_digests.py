@@ -0,0 +1,109 @@
+from optparse import make_option
+from django.core.management.base import NoArgsCommand
+from django.db import transaction
+from django.db.models import Count, Min
+from djangocalais.fields import get_digest_field, url_digest
+from djangocalais.models import Entity, EntityType, EventFact, \
+     EventFactType, SocialTag, Topic, EntityDetection, EventDetection, \
+     SocialTagDetection, TopicDetection
+
+
+class Command(NoArgsCommand):
+    help = ('Fill in the urldigest column of Calais entities, events and '
+            'facts, social tags and topics stored before it existed. Rows '
+            'that share a URL hash, types that share a name and repeated '
+            'detections are merged into the oldest one, so that the '
+            'unique indexes can then be created.')
+    option_list = NoArgsCommand.option_list + (
+        make_option('--batch-size', dest='batch_size', type='int',
+                    default=1000,
+                    help='Number of rows to read per query.'),
+    )
+
+    def handle_noargs(self, **options):
+        verbosity = int(options.get('verbosity', 1))
+        for model in (EntityType, EventFactType):
+            merged = self.merge_duplicates(model, 'name')
+            if verbosity > 0:
+                self.stdout.write('%s: %d duplicates merged\n'
+                                  % (model.__name__, merged))
+        for model in (Entity, EventFact, SocialTag, Topic):
+            updated, merged = self.backfill(model, options['batch_size'])
+            if verbosity > 0:
+                self.stdout.write('%s: %d digests added, %d duplicates '
+                                  'merged\n' % (model.__name__, updated,
+                                                merged))
+        for model in (EntityDetection, EventDetection, SocialTagDetection,
+                      TopicDetection):
+            fields = model._meta.unique_together[0]
+            merged = self.merge_duplicates(model, *fields)
+            if verbosity > 0:
+                self.stdout.write('%s: %d duplicates removed\n'
+                                  % (model.__name__, merged))
+
+    def backfill(self, model, batch_size):
+        digest = get_digest_field(model, 'urlhash')
+        manager = model._default_manager
+        updated = merged = 0
+        last_pk = None
+        while True:
+            batch = manager.filter(**{'%s__isnull' % digest.name: True})
+            if last_pk is not None:
+                batch = batch.filter(pk__gt=last_pk)
+            batch = list(batch.order_by('pk').values_list('pk', 'urlhash')
+                         [:batch_size])
+            if not batch:
+                break
+            for pk, urlhash in batch:
+                value = url_digest(urlhash)
+                existing = manager.filter(**{digest.name: value}) \
+                                  .values_list('pk', flat=True)[:1]
+                if existing:
+                    self.merge(model, existing[0], pk)
+                    merged += 1
+                else:
+                    manager.filter(pk=pk).update(**{digest.name: value})
+                    updated += 1
+            last_pk = batch[-1][0]
+        return updated, merged
+
+    def merge_duplicates(self, model, *fields):
+        """
+        Merge every row of ``model`` into the oldest row with the same
+        values of ``fields``. Returns the number of rows merged.
+        """
+        manager = model._default_manager
+        groups = manager.values(*fields).order_by() \
+                        .annotate(count=Count('pk'), first=Min('pk')) \
+                        .filter(count__gt=1)
+        merged = 0
+        for group in groups:
+            lookup = dict([(field, group[field]) for field in fields])
+            duplicates = manager.filter(**lookup).exclude(pk=group['first'])
+            for pk in duplicates.values_list('pk', flat=True):
+                self.merge(model, group['first'], pk)
+                merged += 1
+        return merged
+
+    @transaction.commit_on_success
+    def merge(self, model, keep_pk, duplicate_pk):
+        """
+        Point everything that refers to the row ``duplicate_pk`` at
+        ``keep_pk`` instead, then delete the duplicate. Referring rows
+        that would then break a unique constraint are deleted.
+        """
+        for related in model._meta.get_all_related_objects():
+            manager = related.model._default_manager
+            name = related.field.name
+            for unique in related.model._meta.unique_together:
+                if name not in unique:
+                    continue
+                others = [field for field in unique if field != name]
+                kept = manager.filter(**{name: keep_pk}) \
+                              .values_list(*others)
+                for values in kept:
+                    lookup = dict(zip(others, values))
+                    lookup[name] = duplicate_pk
+                    manager.filter(**lookup).delete()
+            manager.filter(**{name: duplicate_pk}).update(**{name: keep_pk})
+        model._default_manager.filter(pk=duplicate_pk).delete()
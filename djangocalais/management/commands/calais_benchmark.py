@@ -0,0 +1,106 @@
+import platform
+from optparse import make_option
+try:
+    import simplejson as json
+except ImportError:
+    import json
+from django.contrib.contenttypes.models import ContentType
+from django.core.management.base import NoArgsCommand, CommandError
+from django.db import connection
+from django.db.models import get_model
+from djangocalais import benchmark
+
+
+class Command(NoArgsCommand):
+    help = ('Benchmark the OpenCalais client, the response parsers and the '
+            'storage of results against a local fake server, and print the '
+            'measurements as JSON.')
+    option_list = NoArgsCommand.option_list + (
+        make_option('--output', dest='output', default=None,
+                    help='Write the results to this file instead of '
+                         'standard output.'),
+        make_option('--sizes', dest='sizes', default='10,100,1000',
+                    help='Comma-separated entity counts of the synthetic '
+                         'responses to parse.'),
+        make_option('--requests', dest='requests', type='int', default=100,
+                    help='Number of requests to send to the fake server.'),
+        make_option('--concurrency', dest='concurrency', type='int',
+                    default=4, help='Number of requests sent at once.'),
+        make_option('--latency', dest='latency', type='float', default=0,
+                    help='Seconds the fake server waits before answering.'),
+        make_option('--error-rate', dest='error_rate', type='float',
+                    default=0,
+                    help='Fraction of requests the fake server fails.'),
+        make_option('--no-gzip', action='store_false', dest='gzip',
+                    default=True, help='Send uncompressed responses.'),
+        make_option('--json-response', dest='json_response', default=None,
+                    help='File with a recorded JSON response to replay.'),
+        make_option('--rdf-response', dest='rdf_response', default=None,
+                    help='File with a recorded RDF response to replay.'),
+        make_option('--model', dest='model', default=None,
+                    help='Analyze objects of this model (app_label.Model, '
+                         'with calais_content_fields) instead of content '
+                         'types.'),
+        make_option('--documents', dest='documents', type='int', default=20,
+                    help='Number of objects to analyze.'),
+        make_option('--skip-db', action='store_false', dest='db',
+                    default=True,
+                    help='Skip the benchmark that writes to a test '
+                         'database.'),
+    )
+
+    def handle_noargs(self, **options):
+        try:
+            sizes = [int(size) for size in options['sizes'].split(',')]
+        except ValueError:
+            raise CommandError('--sizes must be a comma-separated list of '
+                               'integers.')
+        recorded = {}
+        for kind in ('json', 'rdf'):
+            path = options['%s_response' % kind]
+            if path:
+                recorded[kind] = open(path, 'rb').read()
+
+        results = benchmark.bench_parsers(sizes, recorded=recorded)
+        results += benchmark.bench_client(
+            options['requests'], options['concurrency'],
+            latency=options['latency'], error_rate=options['error_rate'],
+            gzip=options['gzip'], json_response=recorded.get('json'),
+            rdf_response=recorded.get('rdf'))
+        if options['db']:
+            results += self.bench_analyze(options['model'],
+                                          options['documents'],
+                                          recorded.get('json'))
+
+        report = json.dumps({'python': platform.python_version(),
+                             'database': connection.vendor,
+                             'results': results}, indent=2)
+        if options['output']:
+            f = open(options['output'], 'w')
+            f.write(report)
+            f.close()
+        else:
+            self.stdout.write(report + '\n')
+
+    def bench_analyze(self, model_name, documents, json_response):
+        """
+        Run ``benchmark.bench_analyze`` in a throwaway test database, on
+        up to ``documents`` objects of ``model_name`` or content types.
+        """
+        if model_name:
+            model = get_model(*model_name.split('.', 1))
+            if model is None:
+                raise CommandError('Unknown model: %s' % model_name)
+            # read from the real database; results go to the test one
+            objects = list(model._default_manager.all()[:documents])
+            fields = None
+        old_name = connection.settings_dict['NAME']
+        connection.creation.create_test_db(verbosity=0)
+        try:
+            if not model_name:
+                objects = list(ContentType.objects.all()[:documents])
+                fields = [('name', 'text/txt')]
+            return benchmark.bench_analyze(objects, fields,
+                                           json_response=json_response)
+        finally:
+            connection.creation.destroy_test_db(old_name, verbosity=0)
@@ -0,0 +1,35 @@
+from optparse import make_option
+from django.core.management.base import NoArgsCommand
+from djangocalais.projections import registry
+
+
+class Command(NoArgsCommand):
+    help = ('Rebuild the rows of every registered projection from the '
+            'entities and events and facts already stored, for example '
+            'after registering a new projection.')
+    option_list = NoArgsCommand.option_list + (
+        make_option('--batch-size', dest='batch_size', type='int',
+                    default=500,
+                    help='Number of objects to read per query.'),
+    )
+
+    def handle_noargs(self, **options):
+        verbosity = int(options.get('verbosity', 1))
+        for projection in registry.get_projections():
+            count = 0
+            queryset = projection.source._default_manager \
+                .filter(type__name=projection.calais_type).order_by('pk')
+            last_pk = None
+            while True:
+                batch = queryset
+                if last_pk is not None:
+                    batch = batch.filter(pk__gt=last_pk)
+                batch = list(batch[:options['batch_size']])
+                if not batch:
+                    break
+                projection.sync(batch)
+                count += len(batch)
+                last_pk = batch[-1].pk
+            if verbosity > 0:
+                self.stdout.write('%s: %d rows\n'
+                                  % (projection.model.__name__, count))
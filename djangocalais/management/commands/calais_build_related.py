@@ -0,0 +1,25 @@
+from optparse import make_option
+from django.core.management.base import NoArgsCommand
+from djangocalais import related
+
+
+class Command(NoArgsCommand):
+    help = ('Recompute the related documents of every document from the '
+            'entities, social tags and topics they share.')
+    option_list = NoArgsCommand.option_list + (
+        make_option('--limit', dest='limit', type='int', default=None,
+                    help='Number of related documents to keep per '
+                         'document (default CALAIS_RELATED_LIMIT).'),
+        make_option('--no-scipy', action='store_false', dest='use_scipy',
+                    default=None,
+                    help='Compute in pure Python even if SciPy is '
+                         'installed.'),
+    )
+
+    def handle_noargs(self, **options):
+        verbosity = int(options.get('verbosity', 1))
+        count = related.build(limit=options['limit'],
+                              use_scipy=options['use_scipy'])
+        if verbosity > 0:
+            self.stdout.write('%d documents with related documents\n'
+                              % count)
@@ -0,0 +1,27 @@
+from optparse import make_option
+from django.core.management.base import NoArgsCommand
+from djangocalais.background import run_worker
+
+
+class Command(NoArgsCommand):
+    help = ('Analyze the objects queued by CALAIS_BACKGROUND_ANALYSIS as '
+            'their requests become due.')
+    option_list = NoArgsCommand.option_list + (
+        make_option('--batch-size', dest='batch_size', type='int',
+                    default=100,
+                    help='Number of requests to read per query.'),
+        make_option('--interval', dest='interval', type='float',
+                    default=1.0,
+                    help='Seconds to wait when no request is due.'),
+        make_option('--once', action='store_true', dest='once',
+                    default=False,
+                    help='Exit as soon as no request is due.'),
+    )
+
+    def handle_noargs(self, **options):
+        verbosity = int(options.get('verbosity', 1))
+        handled = run_worker(batch_size=options['batch_size'],
+                             interval=options['interval'],
+                             once=options['once'])
+        if verbosity > 0:
+            self.stdout.write('%d requests handled\n' % handled)
@@ -0,0 +1,224 @@
+"""
+Timings and counters for each stage of an analysis.
+
+Nothing is measured until a sink is added, and until then every hook
+costs a function call that returns at once. A sink is any object with
+``timing(name, seconds)`` and ``incr(name, value)`` methods::
+
+    from djangocalais import metrics
+    stats = metrics.MemorySink()
+    metrics.add_sink(stats)
+    CalaisDocument.objects.analyze(post)
+    stats.summary()
+
+Sinks can also be configured with the ``CALAIS_METRICS_SINKS`` setting,
+a list of dotted paths of sink classes (or other callables returning a
+sink) that are called without arguments when djangocalais is loaded.
+
+Timings, in seconds:
+
+``calais.http``
+    Each request to OpenCalais, from sending it to reading the body.
+``calais.gunzip``
+    Decompressing a gzipped response.
+``calais.decode.json``, ``calais.decode.rdf``
+    Decoding a response (for RDF, including building the hierarchy).
+``calais.hierarchy``
+    Resolving references and grouping a JSON response by type.
+``calais.pickle``, ``calais.unpickle``
+    Encoding and decoding ``PickledObjectField`` values.
+``calais.store.entities``, ``calais.store.events``,
+``calais.store.social_tags``, ``calais.store.topics``, ``calais.store.bulk``
+    Writing the results of one document to the database.
+``calais.document``
+    The whole of ``CalaisDocument.objects.analyze`` for one object.
+
+Counters:
+
+``calais.request_bytes``, ``calais.response_bytes``
+    Bytes sent to and (decompressed) received from OpenCalais.
+``calais.retries``, ``calais.errors``
+    Retried requests, and requests or responses that failed.
+``calais.document.queries``
+    Database queries made analyzing one object.
+``calais.document.entities``, ``calais.document.events``,
+``calais.document.social_tags``, ``calais.document.topics``
+    Items found in the analyzed fields of one object.
+"""
+import logging, threading, time
+
+_sinks = []
+
+
+def add_sink(sink):
+    """
+    Send every measurement to ``sink`` from now on.
+    """
+    if sink not in _sinks:
+        _sinks.append(sink)
+
+def remove_sink(sink):
+    if sink in _sinks:
+        _sinks.remove(sink)
+
+def enabled():
+    """
+    Return whether any sink is listening, for measurements that cost
+    something to compute.
+    """
+    return bool(_sinks)
+
+def timing(name, seconds):
+    for sink in _sinks:
+        sink.timing(name, seconds)
+
+def incr(name, value=1):
+    for sink in _sinks:
+        sink.incr(name, value)
+
+def start():
+    """
+    Return the current time to pass to :func:`stop`, or ``None`` when
+    no sink is listening.
+    """
+    if _sinks:
+        return time.time()
+    return None
+
+def stop(name, started):
+    """
+    Report the time since ``started`` (returned by :func:`start`) as
+    the timing ``name``.
+    """
+    if started is not None:
+        timing(name, time.time() - started)
+
+_configured = False
+
+def configure_from_settings():
+    """
+    Add the sinks named by the ``CALAIS_METRICS_SINKS`` setting, once.
+    """
+    global _configured
+    if _configured:
+        return
+    _configured = True
+    from django.conf import settings
+    from django.utils.importlib import import_module
+    for path in getattr(settings, 'CALAIS_METRICS_SINKS', ()):
+        module, name = path.rsplit('.', 1)
+        add_sink(getattr(import_module(module), name)())
+
+
+class QueryCounter(object):
+    """
+    Counts the queries made on a database connection from the time it
+    is created until :meth:`stop` is called, recording them even when
+    ``DEBUG`` is off. The queries themselves are not kept.
+    """
+    def __init__(self, connection=None):
+        from django.conf import settings
+        if connection is None:
+            from django.db import connection
+        self.connection = connection
+        self.use_debug_cursor = connection.use_debug_cursor
+        # whether the queries would have been recorded anyway
+        self.keep = connection.use_debug_cursor or \
+            (connection.use_debug_cursor is None and settings.DEBUG)
+        self.start = len(connection.queries)
+        connection.use_debug_cursor = True
+
+    def stop(self):
+        """
+        Return the number of queries made and restore the connection.
+        """
+        count = len(self.connection.queries) - self.start
+        if not self.keep:
+            del self.connection.queries[self.start:]
+        self.connection.use_debug_cursor = self.use_debug_cursor
+        return count
+
+
+class LoggingSink(object):
+    """
+    Logs each measurement to the ``djangocalais.metrics`` logger (or
+    ``logger``) at ``level``.
+    """
+    def __init__(self, logger='djangocalais.metrics', level=logging.INFO):
+        self.logger = logging.getLogger(logger)
+        self.level = level
+
+    def timing(self, name, seconds):
+        self.logger.log(self.level, '%s %.1fms', name, seconds * 1000)
+
+    def incr(self, name, value):
+        self.logger.log(self.level, '%s +%s', name, value)
+
+
+class StatsdSink(object):
+    """
+    Forwards measurements to a statsd client, or any object with
+    statsd-style ``timing(name, milliseconds)`` and ``incr(name,
+    count)`` methods, prefixing every name with ``prefix``.
+    """
+    def __init__(self, client, prefix=''):
+        self.client = client
+        self.prefix = prefix
+
+    def timing(self, name, seconds):
+        self.client.timing(self.prefix + name, seconds * 1000)
+
+    def incr(self, name, value):
+        self.client.incr(self.prefix + name, value)
+
+
+class MemorySink(object):
+    """
+    Aggregates measurements in memory. ``summary()`` returns the count,
+    total, minimum, maximum and mean of each timing and the total of
+    each counter. Safe to share between threads.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        self._lock.acquire()
+        try:
+            self.timings = {}
+            self.counters = {}
+        finally:
+            self._lock.release()
+
+    def timing(self, name, seconds):
+        self._lock.acquire()
+        try:
+            stats = self.timings.get(name)
+            if stats is None:
+                self.timings[name] = [1, seconds, seconds, seconds]
+            else:
+                stats[0] += 1
+                stats[1] += seconds
+                stats[2] = min(stats[2], seconds)
+                stats[3] = max(stats[3], seconds)
+        finally:
+            self._lock.release()
+
+    def incr(self, name, value):
+        self._lock.acquire()
+        try:
+            self.counters[name] = self.counters.get(name, 0) + value
+        finally:
+            self._lock.release()
+
+    def summary(self):
+        self._lock.acquire()
+        try:
+            summary = {'timings': {}, 'counters': dict(self.counters)}
+            for name, (count, total, low, high) in self.timings.items():
+                summary['timings'][name] = {
+                    'count': count, 'total': total, 'min': low,
+                    'max': high, 'mean': total / count}
+            return summary
+        finally:
+            self._lock.release()
@@ -1,15 +1,36 @@
+import operator, os, threading, time
 from datetime import datetime
 from django.conf import settings
 from django.contrib.contenttypes.models import ContentType
 from django.contrib.contenttypes import generic
-from django.core.exceptions import ObjectDoesNotExist
 from django.db import models
-from djangocalais.fields import PickledObjectField
-from djangocalais.calaisapi import OpenCalais
+from django.utils.encoding import force_unicode
+from djangocalais import metrics
+from djangocalais.cache import InstanceCache, get_result_cache
+from djangocalais.fields import PickledObjectField, DigestField, \
+     get_digest_field, url_digest
+from djangocalais.calaisapi import OpenCalais, CALAIS_URL, hash_text
+from djangocalais.ratelimit import RateLimiter
+from djangocalais.projections import registry as projections
+from djangocalais.upsert import get_or_insert, insert_ignore
+from djangocalais.utils import parallel_map
 
 
 CONTENT_FIELDS = (models.CharField, models.TextField, models.XMLField)
 
+# Serialization used for ``Entity.attributes`` and ``EventFact.attributes``;
+# see ``PickledObjectField``. Existing rows stay readable if it is changed.
+ATTRIBUTES_CODEC = getattr(settings, 'CALAIS_ATTRIBUTES_CODEC', 'pickle')
+
+# Analyze content longer than the Calais size limit in chunks, with up to
+# ``CHUNK_WORKERS`` chunks in flight, rather than truncating it.
+CHUNKED = getattr(settings, 'CALAIS_CHUNKED', False)
+CHUNK_WORKERS = getattr(settings, 'CALAIS_CHUNK_WORKERS', 4)
+
+# Update the related documents of each document as it is analyzed; see
+# ``djangocalais.related``.
+RELATED_DOCUMENTS = getattr(settings, 'CALAIS_RELATED_DOCUMENTS', False)
+
 def is_content_field(obj, field_name):
     opts = obj._meta
     return isinstance(opts.get_field_by_name(field_name)[0], CONTENT_FIELDS)
@@ -18,21 +39,62 @@ def is_url_field(obj, field_name):
     opts = obj._meta
     return isinstance(opts.get_field_by_name(field_name)[0], models.URLField)
 
+_default_api = None
+_default_api_lock = threading.Lock()
+
+def get_default_api():
+    """
+    Return the ``OpenCalais`` client shared by every analysis in this
+    process, so that its pooled connections and rate limit are shared.
+    It is built from the ``CALAIS_API_KEY`` setting and the optional
+    ``CALAIS_POOL_SIZE``, ``CALAIS_RATE_LIMIT`` (requests per second),
+    ``CALAIS_MAX_CONCURRENT``, ``CALAIS_MAX_RETRIES``,
+    ``CALAIS_DEADLINE``, ``CALAIS_MAX_RESPONSE_SIZE`` and ``CALAIS_URL``
+    settings.
+    """
+    global _default_api
+    if _default_api is None:
+        _default_api_lock.acquire()
+        try:
+            if _default_api is None:
+                rate_limiter = None
+                rate = getattr(settings, 'CALAIS_RATE_LIMIT', None)
+                max_concurrent = getattr(settings, 'CALAIS_MAX_CONCURRENT',
+                                         None)
+                if rate is not None or max_concurrent is not None:
+                    rate_limiter = RateLimiter(rate,
+                                               max_concurrent=max_concurrent)
+                _default_api = OpenCalais(
+                    settings.CALAIS_API_KEY,
+                    cache=get_result_cache(),
+                    pool_size=getattr(settings, 'CALAIS_POOL_SIZE', 4),
+                    rate_limiter=rate_limiter,
+                    max_retries=getattr(settings, 'CALAIS_MAX_RETRIES', 3),
+                    deadline=getattr(settings, 'CALAIS_DEADLINE', 300),
+                    max_response_size=getattr(
+                        settings, 'CALAIS_MAX_RESPONSE_SIZE',
+                        20 * 1024 * 1024),
+                    url=getattr(settings, 'CALAIS_URL', CALAIS_URL))
+        finally:
+            _default_api_lock.release()
+    return _default_api
+
 def analyze_url_field(obj, field_name, content_type='text/html', api=None):
     if api is None:
-        api = OpenCalais(settings.CALAIS_API_KEY)
+        api = get_default_api()
     url = getattr(obj, field_name)
     return api.analyze_url(url, content_type=content_type)
 
 def analyze_content_field(obj, field_name, content_type='text/txt', api=None):
-    if api is None:
-        api = OpenCalais(settings.CALAIS_API_KEY)
     content = getattr(obj, field_name)
-    return api.analyze(content, content_type=content_type)
+    return analyze_content(obj, content, content_type, api)
 
 def analyze_content(obj, content, content_type='text/txt', api=None):
     if api is None:
-        api = OpenCalais(settings.CALAIS_API_KEY)
+        api = get_default_api()
+    if CHUNKED:
+        return api.analyze_chunked(content, content_type=content_type,
+                                   workers=CHUNK_WORKERS)
     return api.analyze(content, content_type=content_type)
         
 class Entity(models.Model):
@@ -55,25 +117,26 @@ class Entity(models.Model):
 
     The trade-off here is that it's not possible to query over extra
     attributes for entities that have them. If you require this
-    functionality it is recommended that you implement a container
-    class that wraps the appropriate ``Entity`` objects and extracts the
+    functionality, register a projection model that copies the
     necessary fields from the ``PickledObjectField`` into true Django
-    ORM fields. For example::
+    ORM fields (see :mod:`djangocalais.projections`). For example::
 
         class PersonEntityWrapper(models.Model):
             entity = models.ForeignKey(Entity)
-            person_type = models.CharField(max_length=300) # Could be FK too
-            nationality = models.CharField(max_length=300)
+            person_type = models.CharField(max_length=300, null=True)
+            nationality = models.CharField(max_length=300, null=True)
 
-    You can then overload save methods to extract the relevant data
-    from the ``Entity`` object's ``attributes`` field. This will enable
-    you to query over these extra fields. Such an implementation may
-    be added to Djangocalais in the near future.
+        projections.register(PersonEntityWrapper, 'Person',
+                             person_type='persontype')
+
+    Its rows are kept in sync whenever a Person entity is stored,
+    enabling you to query over these extra fields.
     """
-    urlhash = models.URLField()
+    urlhash = models.TextField()
+    urldigest = DigestField('urlhash', unique=True)
     type = models.ForeignKey('EntityType')
     name = models.CharField(max_length=300)
-    attributes = PickledObjectField()
+    attributes = PickledObjectField(codec=ATTRIBUTES_CODEC, lazy=True)
 
     def __unicode__(self):
         return u'%s:%s' % (self.type.name, self.name)
@@ -94,7 +157,7 @@ class EntityType(models.Model):
     ``EntityType`` model.
     """
     urlhash = models.URLField()
-    name = models.CharField(max_length=300)
+    name = models.CharField(max_length=300, unique=True)
 
     def __unicode__(self):
         return u'%s' % self.name
@@ -114,22 +177,28 @@ class EventFact(models.Model):
     OpenCalais API response.
 
     As a result, it is not possible to use Django's ORM to query the
-    events and facts results. It is recommend that you implement a
-    wrapper class for the events and facts data that you are
-    interested in for your application. This may be added to
-    Djangocalais in the future. For example::
+    events and facts results directly. It is recommend that you
+    register a projection model for the events and facts data that
+    you are interested in for your application (see
+    :mod:`djangocalais.projections`). For example::
 
         class CompanyEarningsGuidance(models.Model):
             event = models.ForeignKey(EventFact)
-            company = models.ForeignKey(Entity) # This could also be CharField
-            quarter = models.CharField(max_length=25)
-            year = models.DateField()
-            financial_trend = models.CharField(max_length=100)
-            financial_metric = models.CharField(max_length=100)
-
-    The additional field information can be extracted from the
-    ``EventFact`` object's ``PickledObjectField`` at ``save()`` and
-    the data used to fill in the extra fields of the wrapper model. It
+            company = models.CharField(max_length=300, null=True)
+            quarter = models.CharField(max_length=25, null=True)
+            year = models.IntegerField(null=True)
+            financial_trend = models.CharField(max_length=100, null=True)
+            financial_metric = models.CharField(max_length=100, null=True)
+
+        projections.register(CompanyEarningsGuidance,
+                             'CompanyEarningsGuidance',
+                             company='company.name',
+                             financial_trend='financialtrend',
+                             financial_metric='financialmetric')
+
+    The additional field information is extracted from the
+    ``EventFact`` object's ``PickledObjectField`` whenever it is
+    stored and used to fill in the extra fields of the projection. It
     is recommended not to use Django's model inheritance to implement
     these relationships.
 
@@ -154,9 +223,10 @@ class EventFact(models.Model):
     
     http://d.opencalais.com/genericHasher-1/fbb7a225-b658-3253-913a-bdf18108841f
     """
-    urlhash = models.URLField()
+    urlhash = models.TextField()
+    urldigest = DigestField('urlhash', unique=True)
     type = models.ForeignKey('EventFactType')
-    attributes = PickledObjectField()
+    attributes = PickledObjectField(codec=ATTRIBUTES_CODEC, lazy=True)
     
     def __unicode__(self):
         return u'%s' % self.type
@@ -175,7 +245,7 @@ class EventFactType(models.Model):
     (ie. "PersonCareer") and is stored in the ``name`` field.
     """
     urlhash = models.URLField()
-    name = models.CharField(max_length=300)
+    name = models.CharField(max_length=300, unique=True)
 
     def __unicode__(self):
         return u'%s' % self.name
@@ -190,7 +260,8 @@ class SocialTag(models.Model):
     Like all other data provided by Calais, Social Tags can be
     identified by a URL hash value.
     """
-    urlhash = models.URLField()
+    urlhash = models.TextField()
+    urldigest = DigestField('urlhash', unique=True)
     name = models.CharField(max_length=300)
 
     def __unicode__(self):
@@ -202,58 +273,276 @@ class Topic(models.Model):
     analysis. Calais uses both category and topic in references to
     these values. We have chosen to call the model ``Topic``.
     """
-    urlhash = models.URLField()
+    urlhash = models.TextField()
+    urldigest = DigestField('urlhash', unique=True)
     name = models.CharField(max_length=300)
 
     def __unicode__(self):
         return u'%s' % self.name
 
+# Process-local caches for the small Calais vocabularies. Entries are
+# invalidated whenever one of these objects is saved or deleted.
+VOCABULARY_CACHE_SIZE = getattr(settings, 'CALAIS_VOCABULARY_CACHE_SIZE', 1000)
+entity_type_cache = InstanceCache(EntityType, 'name', VOCABULARY_CACHE_SIZE)
+event_type_cache = InstanceCache(EventFactType, 'name', VOCABULARY_CACHE_SIZE)
+social_tag_cache = InstanceCache(SocialTag, 'urlhash', VOCABULARY_CACHE_SIZE)
+topic_cache = InstanceCache(Topic, 'urlhash', VOCABULARY_CACHE_SIZE)
+for vocabulary in (entity_type_cache, event_type_cache, social_tag_cache,
+                   topic_cache):
+    vocabulary.connect()
+
 def make_entity(data, uri):
-    try:
-        obj = Entity.objects.get(urlhash=uri)
-    except ObjectDoesNotExist:
-        if data.has_key('instances'): del data['instances']
-        if data.has_key('resolutions'): del data['resolutions']
-        etype, created = EntityType.objects.get_or_create(
-            name=data['_type'],
-            defaults={'name': data['_type'],
-                      'urlhash': data['_typeReference']})
-        obj = Entity(urlhash=uri,
-                     type=etype,
-                     name=data['name'],
-                     attributes=data)
-        obj.save()
+    if data.has_key('instances'): del data['instances']
+    if data.has_key('resolutions'): del data['resolutions']
+    etype = entity_type_cache.get_or_create(
+        data['_type'],
+        defaults={'name': data['_type'],
+                  'urlhash': data['_typeReference']})
+    obj = Entity(urlhash=uri,
+                 type=etype,
+                 name=data['name'],
+                 attributes=data)
+    obj, created = get_or_insert(Entity, obj, urldigest=url_digest(uri))
+    if created:
+        projections.sync([obj])
     return obj
 
 def make_event(data, uri):
-    try:
-        obj = EventFact.objects.get(urlhash=uri)
-    except ObjectDoesNotExist:
-        if data.has_key('instances'): del data['instances']
-        etype, create = EventFactType.objects.get_or_create(
-            name=data['_type'],
-            defaults={'name': data['_type'], 'urlhash': data['_typeReference']})
-        obj = EventFact(urlhash=uri,
-                        type=etype,
-                        attributes=data)
-        obj.save()
+    if data.has_key('instances'): del data['instances']
+    etype = event_type_cache.get_or_create(
+        data['_type'],
+        defaults={'name': data['_type'], 'urlhash': data['_typeReference']})
+    obj = EventFact(urlhash=uri,
+                    type=etype,
+                    attributes=data)
+    obj, created = get_or_insert(EventFact, obj, urldigest=url_digest(uri))
+    if created:
+        projections.sync([obj])
     return obj
 
 def make_social_tag(data):
-    obj, created = SocialTag.objects.get_or_create(
-        urlhash=data['socialTag'],
+    return social_tag_cache.get_or_create(
+        data['socialTag'],
         defaults={'urlhash': data['socialTag'], 'name': data['name']})
-    return obj
 
 def make_topic(data):
-    obj, created = Topic.objects.get_or_create(
-        urlhash=data['category'],
+    return topic_cache.get_or_create(
+        data['category'],
         defaults={'urlhash': data['category'],
                   'name': data['categoryName']})
-    return obj
+
+# Maximum number of values passed to a single ``IN (...)`` lookup.
+BULK_BATCH_SIZE = 500
+
+def _fetch_by(model, field, values):
+    """
+    Return a dictionary mapping each of ``values`` to the existing
+    ``model`` object whose ``field`` matches it, using as few ``IN``
+    queries as possible. Fields with a ``DigestField`` are looked up
+    through the digest.
+    """
+    found = {}
+    values = list(values)
+    digest = get_digest_field(model, field)
+    for i in range(0, len(values), BULK_BATCH_SIZE):
+        batch = values[i:i + BULK_BATCH_SIZE]
+        if digest is not None:
+            digests = dict([(url_digest(value), value) for value in batch])
+            lookup = {'%s__in' % digest.name: digests.keys()}
+            for obj in model._default_manager.filter(**lookup):
+                found.setdefault(digests[getattr(obj, digest.attname)], obj)
+        else:
+            lookup = {'%s__in' % field: batch}
+            for obj in model._default_manager.filter(**lookup):
+                found.setdefault(getattr(obj, field), obj)
+    return found
+
+def _get_or_create_many(model, field, values, factory, cache=None,
+                        created=None):
+    """
+    Bulk counterpart to ``get_or_create``. ``values`` is a dictionary
+    keyed by the lookup value of ``field``; ``factory`` is called with
+    each missing key and its data to build the unsaved object. Returns
+    a dictionary mapping every key to its saved object.
+
+    If an ``InstanceCache`` is given, it is consulted before the
+    database and filled with whatever had to be loaded. New objects
+    are appended to the ``created`` list, if one is given.
+
+    Missing objects are inserted with ``insert_ignore``, so objects
+    created concurrently by another process are picked up rather than
+    duplicated, provided ``field`` is unique.
+    """
+    found = {}
+    if cache is not None:
+        for key in values.keys():
+            obj = cache.get(key)
+            if obj is not None:
+                found[key] = obj
+    found.update(_fetch_by(model, field,
+                           [key for key in values.keys() if key not in found]))
+    missing = [factory(key, data) for key, data in values.items()
+               if key not in found]
+    if missing:
+        insert_ignore(model, missing)
+        # multi-row inserts do not set primary keys, so reload the rows
+        new = _fetch_by(model, field, [getattr(obj, field) for obj in missing])
+        found.update(new)
+        if created is not None:
+            created.extend(new.values())
+    if cache is not None:
+        map(cache.add, found.values())
+    return found
+
+def make_entities(entities, created=None):
+    """
+    Bulk version of ``make_entity``. ``entities`` is a dictionary of
+    Calais entity data keyed by URI.
+    """
+    types = dict([(data['_type'], data['_typeReference'])
+                  for data in entities.values()])
+    etypes = _get_or_create_many(
+        EntityType, 'name', types,
+        lambda name, ref: EntityType(name=name, urlhash=ref),
+        entity_type_cache, created)
+    def build(uri, data):
+        if data.has_key('instances'): del data['instances']
+        if data.has_key('resolutions'): del data['resolutions']
+        return Entity(urlhash=uri,
+                      type=etypes[data['_type']],
+                      name=data['name'],
+                      attributes=data)
+    return _get_or_create_many(Entity, 'urlhash', entities, build,
+                               created=created)
+
+def make_events(events, created=None):
+    """
+    Bulk version of ``make_event``. ``events`` is a dictionary of
+    Calais event and fact data keyed by URI.
+    """
+    types = dict([(data['_type'], data['_typeReference'])
+                  for data in events.values()])
+    etypes = _get_or_create_many(
+        EventFactType, 'name', types,
+        lambda name, ref: EventFactType(name=name, urlhash=ref),
+        event_type_cache, created)
+    def build(uri, data):
+        if data.has_key('instances'): del data['instances']
+        return EventFact(urlhash=uri,
+                         type=etypes[data['_type']],
+                         attributes=data)
+    return _get_or_create_many(EventFact, 'urlhash', events, build,
+                               created=created)
+
+def make_social_tags(social_tags, created=None):
+    """
+    Bulk version of ``make_social_tag``. Returns a dictionary mapping
+    each social tag URL hash to its ``SocialTag``.
+    """
+    names = dict([(data['socialTag'], data['name'])
+                  for data in social_tags.values()])
+    return _get_or_create_many(
+        SocialTag, 'urlhash', names,
+        lambda uri, name: SocialTag(urlhash=uri, name=name),
+        social_tag_cache, created)
+
+def make_topics(topics, created=None):
+    """
+    Bulk version of ``make_topic``. Returns a dictionary mapping each
+    category URL hash to its ``Topic``.
+    """
+    names = dict([(data['category'], data['categoryName'])
+                  for data in topics.values()])
+    return _get_or_create_many(
+        Topic, 'urlhash', names,
+        lambda uri, name: Topic(urlhash=uri, name=name),
+        topic_cache, created)
+
+class AnalysisStats(object):
+    """
+    Running totals for :meth:`CalaisDocumentManager.analyze_queryset`.
+    ``db_writes`` counts the rows inserted, the stale detections
+    deleted and the ``AnalyzedField`` records saved while storing
+    results.
+    """
+    def __init__(self):
+        self.started = time.time()
+        self.documents = 0
+        self.api_calls = 0
+        self.db_writes = 0
+
+    def _rate(self, count):
+        elapsed = time.time() - self.started
+        if elapsed <= 0:
+            return 0.0
+        return count / elapsed
+
+    def __unicode__(self):
+        return u'%d documents (%.1f docs/sec, %.1f API calls/sec, ' \
+            u'%.1f DB writes/sec)' % (self.documents,
+                                      self._rate(self.documents),
+                                      self._rate(self.api_calls),
+                                      self._rate(self.db_writes))
+
+def read_checkpoint(path):
+    """
+    Return the primary key recorded in the checkpoint file at
+    ``path``, or ``None`` if there is no checkpoint.
+    """
+    if path is None or not os.path.exists(path):
+        return None
+    f = open(path)
+    try:
+        value = f.read().strip()
+    finally:
+        f.close()
+    if not value:
+        return None
+    try:
+        return int(value)
+    except ValueError:
+        return value
+
+def write_checkpoint(path, pk):
+    if path is None:
+        return
+    tmp = '%s.tmp' % path
+    f = open(tmp, 'w')
+    try:
+        f.write('%s\n' % pk)
+    finally:
+        f.close()
+    os.rename(tmp, path)
+
+def field_fingerprint(obj, field_name):
+    """
+    Return the SHA-1 fingerprint of a field's current content, the same
+    hash that ``OpenCalais`` sends as the ``externalID``. For URLFields
+    this is the fingerprint of the URL itself.
+    """
+    return hash_text(force_unicode(getattr(obj, field_name) or u''))
+
+def _result_items(result):
+    """
+    Return the URL hash digests of the entities, events and facts,
+    social tags and topics in a Calais ``result``.
+    """
+    return {
+        'entities': [url_digest(uri)
+                     for items in result.get('entities', {}).values()
+                     for uri in items],
+        'events': [url_digest(uri)
+                   for items in result.get('relations', {}).values()
+                   for uri in items],
+        'social_tags': [url_digest(data['socialTag'])
+                        for data in result.get('socialTag', {}).values()],
+        'topics': [url_digest(data['category'])
+                   for data in result.get('topics', {}).values()],
+    }
 
 class CalaisDocumentManager(models.Manager):
-    def analyze(self, obj, fields=None, api=None):
+    def analyze(self, obj, fields=None, api=None, bulk=False,
+                concurrency=1, force=False):
         """
         Analyze a Django object. The optional ``fields`` parameter is
         a list of 2-tuples that represent the field names to use as
@@ -280,6 +569,46 @@ class CalaisDocumentManager(models.Manager):
         ``calais_content_fields``. For example::
 
             calais_content_fields = [('title', 'text/txt'), ('url', 'text/html')]
+
+        Passing ``bulk=True`` persists the results with
+        :meth:`add_results`, which issues a roughly constant number of
+        queries per document regardless of how many entities Calais
+        returns.
+
+        With ``concurrency`` greater than 1, up to that many fields are
+        sent to OpenCalais (or, for URLFields, fetched) in parallel
+        threads. Results are stored once every field has been
+        analyzed.
+
+        A fingerprint of each analyzed field is stored with the
+        document, and on later calls only fields whose content (or,
+        for URLFields, URL) or content type has changed are sent to
+        OpenCalais again. The detections found only in the previous
+        version of a changed field are removed. Pass ``force=True`` to
+        analyze every field regardless.
+
+        The time taken and the queries made are reported to any
+        metrics sinks (see ``djangocalais.metrics``).
+        """
+        started = metrics.start()
+        if started is not None:
+            queries = metrics.QueryCounter()
+        try:
+            document, changed, previous = self._plan(obj, fields, force)
+            if changed:
+                results = self.analyze_fields(obj, changed, api, concurrency)
+                self._store(document, obj, changed, previous, results, bulk)
+        finally:
+            if started is not None:
+                metrics.incr('calais.document.queries', queries.stop())
+                metrics.stop('calais.document', started)
+        return document
+
+    def get_analyzable_fields(self, obj, fields=None):
+        """
+        Return the ``(field name, content type)`` pairs of ``fields``
+        (or of ``calais_content_fields``) that can be analyzed, in the
+        order :meth:`analyze_fields` returns their results.
         """
         if fields is None:
             # try to get fields list from class attribute
@@ -290,70 +619,302 @@ class CalaisDocumentManager(models.Manager):
         url_fields = filter(lambda x: is_url_field(obj, x[0]), fields)
         # ignore "non-content" fields
         content_fields = filter(lambda x: is_content_field(obj, x[0]), fields)
-        # analyze with OpenCalais API
-        url_results = map(
-            lambda x: analyze_url_field(obj, x[0], x[1], api),
-            url_fields)
-        content_results = map(
-            lambda x: analyze_content_field(obj, x[0], x[1], api),
-            content_fields)
-        results = url_results + content_results
+        return url_fields + content_fields
+
+    def analyze_fields(self, obj, fields=None, api=None, concurrency=1):
+        """
+        Send the fields of ``obj`` to OpenCalais and return the list of
+        results, one per analyzed field, without touching the
+        database. Arguments are as for :meth:`analyze`.
+        """
+        fields = self.get_analyzable_fields(obj, fields)
+        # analyze with OpenCalais API, up to ``concurrency`` fields at once
+        def analyze_field(x):
+            if is_url_field(obj, x[0]):
+                return analyze_url_field(obj, x[0], x[1], api)
+            return analyze_content_field(obj, x[0], x[1], api)
+        return parallel_map(analyze_field, fields, concurrency)
+
+    def save_results(self, obj, results, bulk=False):
+        """
+        Store the ``results`` of analyzing ``obj`` and return its
+        ``CalaisDocument``.
+        """
+        document = self._get_or_create_document(obj)
+        self._add(document, results, bulk)
+        return document
+
+    def _add(self, document, results, bulk):
+        if bulk:
+            started = metrics.start()
+            inserted = self.add_results(document, results)
+            metrics.stop('calais.store.bulk', started)
+            return inserted
+        for kind, add in (('entities', self.add_entities),
+                          ('events', self.add_events),
+                          ('social_tags', self.add_social_tags),
+                          ('topics', self.add_topics)):
+            started = metrics.start()
+            map(lambda x: add(document, x), results)
+            metrics.stop('calais.store.%s' % kind, started)
+        return 0
+
+    def _get_or_create_document(self, obj):
         content_type = ContentType.objects.get_for_model(obj)
         document, created = self.get_or_create(
             content_type=content_type,
             object_id=obj.pk,
             defaults={'content_type': content_type, 'object_id': obj.pk})
-        map(lambda x: self.add_entities(document, x), results)
-        map(lambda x: self.add_events(document, x), results)
-        map(lambda x: self.add_social_tags(document, x), results)
-        map(lambda x: self.add_topics(document, x), results)
         return document
 
+    def _plan(self, obj, fields, force):
+        """
+        Return the document of ``obj``, the analyzable fields that
+        need analyzing and a dictionary of the ``AnalyzedField``
+        records of the document, keyed by field name.
+        """
+        fields = self.get_analyzable_fields(obj, fields)
+        document = self._get_or_create_document(obj)
+        previous = dict([(record.field_name, record)
+                         for record in document.analyzed_fields.all()])
+        changed = []
+        for field_name, content_type in fields:
+            record = previous.get(field_name)
+            if force or record is None or \
+                    record.content_type != content_type or \
+                    record.fingerprint != field_fingerprint(obj, field_name):
+                changed.append((field_name, content_type))
+        return document, changed, previous
+
+    def _store(self, document, obj, fields, previous, results, bulk):
+        """
+        Store the ``results`` of analyzing ``fields`` of ``obj``,
+        removing detections that only the previous versions of those
+        fields produced, and record the new fingerprints. Fields that
+        could not be analyzed (an empty result) are left as they were.
+        Returns the number of rows inserted, deleted or updated.
+        """
+        analyzed = [(field, result) for field, result in zip(fields, results)
+                    if result]
+        names = set([field_name for (field_name, ct), r in analyzed])
+        items = {}
+        for (field_name, content_type), result in analyzed:
+            items[field_name] = _result_items(result)
+            if metrics.enabled():
+                for kind, digests in items[field_name].items():
+                    metrics.incr('calais.document.%s' % kind, len(digests))
+        # items still produced by some field must keep their detections
+        keep = {}
+        for field_name, record in previous.items():
+            if field_name not in names:
+                for kind, digests in (record.items or {}).items():
+                    keep.setdefault(kind, set()).update(digests)
+        for field_items in items.values():
+            for kind, digests in field_items.items():
+                keep.setdefault(kind, set()).update(digests)
+        writes = 0
+        for field_name in names:
+            if field_name in previous:
+                writes += self._remove_detections(
+                    document, previous[field_name].items, keep)
+
+        writes += self._add(document, [r for f, r in analyzed], bulk)
+
+        for (field_name, content_type), result in analyzed:
+            record = previous.get(field_name)
+            if record is None:
+                record = AnalyzedField(document=document,
+                                       field_name=field_name)
+            record.content_type = content_type
+            record.fingerprint = field_fingerprint(obj, field_name)
+            record.url = is_url_field(obj, field_name) and \
+                getattr(obj, field_name) or None
+            record.items = items[field_name]
+            record.save()
+            writes += 1
+        if RELATED_DOCUMENTS and analyzed:
+            from djangocalais import related
+            related.update_document(document)
+        return writes
+
+    def _remove_detections(self, document, items, keep):
+        """
+        Delete the detections of ``document`` for the ``items`` of a
+        previous analysis that are not in ``keep``, and return how
+        many were deleted.
+        """
+        detections = (('entities', EntityDetection, 'entity'),
+                      ('events', EventDetection, 'event_or_fact'),
+                      ('social_tags', SocialTagDetection, 'social_tag'),
+                      ('topics', TopicDetection, 'topic'))
+        removed = 0
+        for kind, model, field in detections:
+            stale = [digest for digest in (items or {}).get(kind, [])
+                     if digest not in keep.get(kind, ())]
+            for i in range(0, len(stale), BULK_BATCH_SIZE):
+                lookup = {'document': document,
+                          '%s__urldigest__in' % field:
+                              stale[i:i + BULK_BATCH_SIZE]}
+                queryset = model._default_manager.filter(**lookup)
+                # delete() does not say how many rows it removed
+                removed += queryset.count()
+                queryset.delete()
+        return removed
+
+    def analyze_queryset(self, queryset, fields=None, api=None,
+                         batch_size=100, workers=1, checkpoint=None,
+                         progress=None, force=False):
+        """
+        Analyze every object in ``queryset``, for backfilling large
+        tables. Objects are read in primary key order, ``batch_size``
+        at a time, using ``pk > last`` ranges rather than offsets.
+        Within a batch, up to ``workers`` objects are sent to
+        OpenCalais in parallel; results are then stored with
+        :meth:`add_results`. As with :meth:`analyze`, only fields that
+        have changed since they were last analyzed are sent, unless
+        ``force`` is true.
+
+        If ``checkpoint`` is the path of a file, the primary key of the
+        last stored object is written to it after every batch, and an
+        existing checkpoint is resumed from. ``progress``, if given, is
+        called after every batch with a :class:`AnalysisStats`.
+        Returns the final ``AnalysisStats``.
+        """
+        stats = AnalysisStats()
+        last_pk = read_checkpoint(checkpoint)
+        queryset = queryset.order_by('pk')
+        while True:
+            batch = queryset
+            if last_pk is not None:
+                batch = batch.filter(pk__gt=last_pk)
+            batch = list(batch[:batch_size])
+            if not batch:
+                break
+            plans = [self._plan(obj, fields, force) for obj in batch]
+            all_results = parallel_map(
+                lambda (obj, plan): plan[1] and
+                    self.analyze_fields(obj, plan[1], api) or [],
+                zip(batch, plans), workers)
+            for obj, plan, results in zip(batch, plans, all_results):
+                document, changed, previous = plan
+                if changed:
+                    stats.db_writes += self._store(document, obj, changed,
+                                                   previous, results, True)
+                stats.api_calls += len(results)
+                stats.documents += 1
+            last_pk = batch[-1].pk
+            write_checkpoint(checkpoint, last_pk)
+            if progress is not None:
+                progress(stats)
+        return stats
+
+    def add_results(self, document, results):
+        """
+        Store a list of Calais ``results`` for ``document`` in bulk.
+
+        Existing entities, events and facts, social tags, topics and
+        their detections are loaded with a handful of ``IN`` queries
+        keyed by URL hash, and only the missing rows are inserted
+        (using multi-row ``insert_ignore`` statements). When the
+        same item appears in more than one result, the first
+        occurrence wins, as it does with :meth:`add_entities` and
+        friends. Returns the number of rows inserted.
+        """
+        entities, events, social_tags, topics = {}, {}, {}, {}
+        for result in results:
+            for etype, items in result.get('entities', {}).items():
+                for uri, data in items.items():
+                    entities.setdefault(uri, data)
+            for etype, items in result.get('relations', {}).items():
+                for uri, data in items.items():
+                    events.setdefault(uri, data)
+            for uri, data in result.get('socialTag', {}).items():
+                social_tags.setdefault(uri, data)
+            for uri, data in result.get('topics', {}).items():
+                topics.setdefault(uri, data)
+
+        created = []
+        inserted = 0
+        entity_objs = make_entities(entities, created)
+        seen = set(document.entity_detections.values_list('entity',
+                                                          flat=True))
+        detections = []
+        for uri, data in entities.items():
+            entity = entity_objs[uri]
+            if entity.pk in seen: continue
+            seen.add(entity.pk)
+            detections.append(EntityDetection(
+                entity=entity, document=document, urlhash=uri,
+                relevance=data['relevance']))
+        inserted += insert_ignore(EntityDetection, detections)
+
+        event_objs = make_events(events, created)
+        seen = set(document.event_detections.values_list('event_or_fact',
+                                                         flat=True))
+        detections = []
+        for uri in events.keys():
+            event = event_objs[uri]
+            if event.pk in seen: continue
+            seen.add(event.pk)
+            detections.append(EventDetection(
+                event_or_fact=event, document=document, urlhash=uri))
+        inserted += insert_ignore(EventDetection, detections)
+
+        tag_objs = make_social_tags(social_tags, created)
+        seen = set(document.social_tag_detections.values_list('social_tag',
+                                                              flat=True))
+        detections = []
+        for uri, data in social_tags.items():
+            social_tag = tag_objs[data['socialTag']]
+            if social_tag.pk in seen: continue
+            seen.add(social_tag.pk)
+            detections.append(SocialTagDetection(
+                social_tag=social_tag, document=document, urlhash=uri,
+                importance=data['importance']))
+        inserted += insert_ignore(SocialTagDetection, detections)
+
+        topic_objs = make_topics(topics, created)
+        seen = set(document.topic_detections.values_list('topic', flat=True))
+        detections = []
+        for uri, data in topics.items():
+            topic = topic_objs[data['category']]
+            if topic.pk in seen: continue
+            seen.add(topic.pk)
+            detections.append(TopicDetection(
+                topic=topic, document=document, urlhash=uri,
+                score=data.get('score', 0)))
+        inserted += insert_ignore(TopicDetection, detections)
+        projections.sync(created)
+        return inserted + len(created)
+
     def add_entities(self, document, result):
-        get_or_create = EntityDetection.objects.get_or_create
         for etype, entities in result.get('entities', {}).items():
             for uri, entity_data in entities.items():
                 entity = make_entity(entity_data, uri)
-                get_or_create(
-                    entity=entity,
-                    document=document,
-                    defaults={'entity': entity, 'document': document,
-                              'urlhash': uri,
-                              'relevance': entity_data['relevance']})
+                insert_ignore(EntityDetection, [EntityDetection(
+                    entity=entity, document=document, urlhash=uri,
+                    relevance=entity_data['relevance'])])
             
     def add_events(self, document, result):
-        get_or_create = EventDetection.objects.get_or_create
         for etype, events in result.get('relations', {}).items():
             for uri, event_data in events.items():
                 event = make_event(event_data, uri)
-                get_or_create(
-                    event_or_fact=event,
-                    document=document,
-                    defaults={'event_or_fact': event, 'document': document,
-                              'urlhash': uri})
+                insert_ignore(EventDetection, [EventDetection(
+                    event_or_fact=event, document=document, urlhash=uri)])
 
     def add_social_tags(self, document, result):
-        get_or_create = SocialTagDetection.objects.get_or_create
         for uri, social_tag_data in result.get('socialTag', {}).items():
             social_tag = make_social_tag(social_tag_data)
-            get_or_create(
-                social_tag=social_tag,
-                document=document,
-                defaults={'social_tag': social_tag,
-                          'document': document,
-                          'urlhash': uri,
-                          'importance': social_tag_data['importance']})
+            insert_ignore(SocialTagDetection, [SocialTagDetection(
+                social_tag=social_tag, document=document, urlhash=uri,
+                importance=social_tag_data['importance'])])
 
     def add_topics(self, document, result):
-        get_or_create = TopicDetection.objects.get_or_create
         for uri, topic_data in result.get('topics', {}).items():
             topic = make_topic(topic_data)
             score = topic_data.get('score', 0)
-            get_or_create(
-                topic=topic,
-                document=document,
-                defaults={'topic': topic, 'document': document,
-                          'urlhash': uri, 'score': score})
+            insert_ignore(TopicDetection, [TopicDetection(
+                topic=topic, document=document, urlhash=uri, score=score)])
  
     def get_document_for_object(self, obj):
         """
@@ -363,7 +924,108 @@ class CalaisDocumentManager(models.Manager):
         """
         content_type = ContentType.objects.get_for_model(obj)
         return self.get(content_type=content_type, object_id=obj.pk)
-        
+
+    def get_documents_for_objects(self, objs, attr='calais_document'):
+        """
+        Return the ``CalaisDocument`` of each of ``objs`` (a list or
+        queryset of objects of any models), or ``None`` for objects
+        that have not been analyzed, in the same order. Each document
+        is also set as the ``attr`` attribute of its object.
+
+        The documents are loaded with their detections and the
+        entities (with their types), events and facts, social tags and
+        topics detected, in a fixed number of queries however many
+        objects there are. The detections are available as lists in
+        the ``entity_detection_list``, ``event_detection_list``,
+        ``social_tag_detection_list`` and ``topic_detection_list``
+        attributes of each document. For example, for a page of blog
+        posts::
+
+            posts = BlogEntry.objects.all()[:50]
+            CalaisDocument.objects.get_documents_for_objects(posts)
+            for post in posts:
+                if post.calais_document is not None:
+                    tags = [d.social_tag.name for d in
+                            post.calais_document.social_tag_detection_list]
+
+        A queryset keeps the objects it loaded, so iterating over it
+        again (in a template, say) gives the objects with documents.
+        """
+        objs = list(objs)
+        keys = [(ContentType.objects.get_for_model(obj).pk, obj.pk)
+                for obj in objs]
+        unique_keys = list(set(keys))
+        documents = {}
+        for i in range(0, len(unique_keys), BULK_BATCH_SIZE):
+            ids = {}
+            for content_type_id, object_id in \
+                    unique_keys[i:i + BULK_BATCH_SIZE]:
+                ids.setdefault(content_type_id, []).append(object_id)
+            # one query for every content type
+            lookup = reduce(operator.or_, [
+                models.Q(content_type=content_type_id,
+                         object_id__in=object_ids)
+                for content_type_id, object_ids in ids.items()])
+            for document in self.filter(lookup):
+                documents[(document.content_type_id, document.object_id)] = \
+                    document
+        _attach_detections(documents.values())
+        results = []
+        for obj, key in zip(objs, keys):
+            document = documents.get(key)
+            if document is not None:
+                document._content_object_cache = obj
+            setattr(obj, attr, document)
+            results.append(document)
+        return results
+
+    def get_postings(self, item):
+        """
+        Return the detections of ``item`` (an ``Entity``, ``SocialTag``
+        or ``Topic``) as a queryset ordered from the most relevant
+        document to the least: by relevance or score, highest first,
+        or by importance, lowest (most important) first. Documents
+        are included. This is the posting list of ``item`` in an index
+        kept by the database, so reading any page of it (for example
+        with Django's ``Paginator``) does not sort the detections.
+        """
+        model, field, score, descending = _get_posting_fields(item)
+        if descending:
+            score = '-%s' % score
+        return model._default_manager.filter(**{field: item}) \
+                    .select_related('document') \
+                    .order_by(score, '-document')
+
+    def top_documents(self, item, limit=10, after=None):
+        """
+        Return a list of the ``limit`` documents most relevant to
+        ``item`` (an ``Entity``, ``SocialTag`` or ``Topic``), each with
+        a ``score`` attribute holding the relevance, importance or
+        score of ``item`` in it.
+
+        To read the next page, pass the ``(score, pk)`` of the last
+        document returned as ``after``. Unlike an offset, this costs
+        the same however deep the page is::
+
+            page = CalaisDocument.objects.top_documents(apple, 20)
+            more = CalaisDocument.objects.top_documents(
+                apple, 20, after=(page[-1].score, page[-1].pk))
+        """
+        postings = self.get_postings(item)
+        if after is not None:
+            model, field, score, descending = _get_posting_fields(item)
+            after_score, after_pk = after
+            worse = descending and 'lt' or 'gt'
+            postings = postings.filter(
+                models.Q(**{'%s__%s' % (score, worse): after_score}) |
+                models.Q(**{score: after_score, 'document__lt': after_pk}))
+        documents = []
+        for detection in postings[:limit]:
+            document = detection.document
+            document.score = detection.score
+            documents.append(document)
+        return documents
+
 class CalaisDocument(models.Model):
     """
     A ``CalaisDocument`` is anything that has been analyzed by the
@@ -395,6 +1057,45 @@ class CalaisDocument(models.Model):
     def __unicode__(self):
         return u'%s' % self.content_object
 
+    def get_related(self, limit=None):
+        """
+        Return the documents most similar to this one, best first, each
+        with a ``score`` attribute between 0 and 1, as last computed by
+        :mod:`djangocalais.related`.
+        """
+        rows = self.related_documents.select_related('related') \
+                   .order_by('-score', 'related')
+        if limit is not None:
+            rows = rows[:limit]
+        documents = []
+        for row in rows:
+            document = row.related
+            document.score = row.score
+            documents.append(document)
+        return documents
+
+class AnalyzedField(models.Model):
+    """
+    A field of a ``CalaisDocument``'s object as it was last analyzed:
+    its content type, the SHA-1 fingerprint of its content (or URL)
+    and the URL hash digests of what Calais found in it. These let
+    :meth:`CalaisDocumentManager.analyze` skip fields that have not
+    changed, and replace the detections of those that have.
+    """
+    document = models.ForeignKey(CalaisDocument,
+                                 related_name='analyzed_fields')
+    field_name = models.CharField(max_length=100)
+    content_type = models.CharField(max_length=50)
+    fingerprint = models.CharField(max_length=40)
+    url = models.URLField(null=True, blank=True)
+    items = PickledObjectField(codec=ATTRIBUTES_CODEC, null=True)
+
+    class Meta:
+        unique_together = (('document', 'field_name'),)
+
+    def __unicode__(self):
+        return u'%s' % self.field_name
+
 class EntityDetection(models.Model):
     """
     A specific entity detected within a document. This includes the
@@ -405,12 +1106,12 @@ class EntityDetection(models.Model):
     Example usage::
 
         # CalaisDocument contains an article about Apple iPods...
-        >>> print d.content_object
-        Apple rumor: iPhones and iPod touches may add micro projectors
+        print d.content_object
+        # Apple rumor: iPhones and iPod touches may add micro projectors
 
         # List the entities and their relevance scores for document d        
-        >>> [(x.entity.name, '%.3f' % x.relevance) for x in d.entity_detections.all()]
-        [(u'form-factor handheld devices', '0.200'), (u'rumor site', '0.322'), (u'Online Backup', '0.099'), (u'micro projector technology', '0.322'), (u'preferred online storage', '0.099'), (u'iPod', '0.582'), (u'iPhone', '0.506'), (u'Taiwan', '0.267'), (u'Apple', '0.380'), (u'Samsung', '0.267'), (u'Foxlink', '0.322'), (u'Nokia', '0.267'), (u'Foxconn', '0.322'), (u'digital video', '0.343'), (u'micro projector technology', '0.322'), (u'iPod', '0.857')]
+        [(x.entity.name, '%.3f' % x.relevance) for x in d.entity_detections.all()]
+        # [(u'form-factor handheld devices', '0.200'), (u'rumor site', '0.322'), (u'Online Backup', '0.099'), (u'micro projector technology', '0.322'), (u'preferred online storage', '0.099'), (u'iPod', '0.582'), (u'iPhone', '0.506'), (u'Taiwan', '0.267'), (u'Apple', '0.380'), (u'Samsung', '0.267'), (u'Foxlink', '0.322'), (u'Nokia', '0.267'), (u'Foxconn', '0.322'), (u'digital video', '0.343'), (u'micro projector technology', '0.322'), (u'iPod', '0.857')]
 
     This model handles the ``ManyToManyField`` relationship for
     all ``CalaisDocument`` and ``Entity`` models.        
@@ -418,9 +1119,12 @@ class EntityDetection(models.Model):
     entity = models.ForeignKey(Entity)
     document = models.ForeignKey(CalaisDocument,
                                  related_name='entity_detections')
-    urlhash = models.URLField()    
+    urlhash = models.TextField()
     relevance = models.FloatField()
 
+    class Meta:
+        unique_together = (('document', 'entity'),)
+
     def __unicode__(self):
         return u'%s' % self.entity
 
@@ -441,7 +1145,10 @@ class EventDetection(models.Model):
     event_or_fact = models.ForeignKey(EventFact)
     document = models.ForeignKey(CalaisDocument,
                                  related_name='event_detections')
-    urlhash = models.URLField()
+    urlhash = models.TextField()
+
+    class Meta:
+        unique_together = (('document', 'event_or_fact'),)
 
     def __unicode__(self):
         return u'%s' % self.event_or_fact
@@ -458,9 +1165,12 @@ class SocialTagDetection(models.Model):
     social_tag = models.ForeignKey(SocialTag)
     document = models.ForeignKey(CalaisDocument,
                                  related_name='social_tag_detections')
-    urlhash = models.URLField()
+    urlhash = models.TextField()
     importance = models.IntegerField()
 
+    class Meta:
+        unique_together = (('document', 'social_tag'),)
+
     def __unicode__(self):
         return u'%s' % self.social_tag
 
@@ -480,8 +1190,97 @@ class TopicDetection(models.Model):
     topic = models.ForeignKey(Topic)
     document = models.ForeignKey(CalaisDocument,
                                  related_name='topic_detections')
-    urlhash = models.URLField()
+    urlhash = models.TextField()
     score = models.FloatField()
 
+    class Meta:
+        unique_together = (('document', 'topic'),)
+
     def __unicode__(self):
         return u'%s' % self.topic
+
+class RelatedDocument(models.Model):
+    """
+    One of the documents most similar to ``document`` by the entities,
+    social tags and topics they share, with the cosine similarity of
+    the two as ``score``. These rows are maintained by
+    :mod:`djangocalais.related`; read them with
+    :meth:`CalaisDocument.get_related`.
+    """
+    document = models.ForeignKey(CalaisDocument,
+                                 related_name='related_documents')
+    related = models.ForeignKey(CalaisDocument, related_name='+')
+    score = models.FloatField()
+
+    class Meta:
+        unique_together = (('document', 'related'),)
+
+    def __unicode__(self):
+        return u'%s' % self.related
+
+def _attach_detections(documents):
+    """
+    Load the detections of ``documents``, with what was detected, into
+    list attributes of each document (see
+    :meth:`CalaisDocumentManager.get_documents_for_objects`).
+    """
+    by_pk = dict([(document.pk, document) for document in documents])
+    detections = (
+        ('entity_detection_list', EntityDetection, ('entity', 'entity__type')),
+        ('event_detection_list', EventDetection,
+         ('event_or_fact', 'event_or_fact__type')),
+        ('social_tag_detection_list', SocialTagDetection, ('social_tag',)),
+        ('topic_detection_list', TopicDetection, ('topic',)))
+    for attr, model, related in detections:
+        for document in documents:
+            setattr(document, attr, [])
+        pks = by_pk.keys()
+        for i in range(0, len(pks), BULK_BATCH_SIZE):
+            queryset = model._default_manager.select_related(*related) \
+                .filter(document__in=pks[i:i + BULK_BATCH_SIZE]) \
+                .order_by('pk')
+            for detection in queryset:
+                document = by_pk[detection.document_id]
+                detection._document_cache = document
+                getattr(document, attr).append(detection)
+
+def _get_posting_fields(item):
+    """
+    Return the detection model of ``item``, the name of its foreign key
+    to the kind of item, the name of its score field and whether higher
+    scores are better. An importance of 1 is the most important.
+    """
+    if isinstance(item, Entity):
+        return EntityDetection, 'entity', 'relevance', True
+    if isinstance(item, SocialTag):
+        return SocialTagDetection, 'social_tag', 'importance', False
+    if isinstance(item, Topic):
+        return TopicDetection, 'topic', 'score', True
+    raise TypeError('Expected an Entity, SocialTag or Topic, got %r' % item)
+
+class AnalysisRequest(models.Model):
+    """
+    An object waiting to be analyzed by the background worker (see
+    :mod:`djangocalais.background`). There is at most one request per
+    object; saving the object again before it is analyzed only pushes
+    ``due`` back, so a burst of saves leads to a single analysis.
+    """
+    content_type = models.ForeignKey(ContentType,
+                                     related_name='calais_requests')
+    object_id = models.PositiveIntegerField()
+    content_object = generic.GenericForeignKey('content_type', 'object_id')
+    due = models.DateTimeField(db_index=True)
+    locked_until = models.DateTimeField(null=True, blank=True)
+    attempts = models.PositiveIntegerField(default=0)
+
+    class Meta:
+        unique_together = (('content_type', 'object_id'),)
+
+    def __unicode__(self):
+        return u'%s.%s' % (self.content_type, self.object_id)
+
+if getattr(settings, 'CALAIS_BACKGROUND_ANALYSIS', False):
+    from djangocalais import background
+    background.connect()
+
+metrics.configure_from_settings()
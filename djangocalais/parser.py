@@ -1,12 +1,27 @@
+import logging
+from cStringIO import StringIO
 from xml.dom import minidom
 from xml.dom.minidom import Comment
+try:
+    from xml.etree.cElementTree import iterparse
+except ImportError:
+    from xml.etree.ElementTree import iterparse
+
+log = logging.getLogger('djangocalais')
 
 
 class CalaisParser:
-    results = {}
+    """
+    Parses an OpenCalais RDF document that has already been loaded with
+    minidom. All state belongs to the parser instance, and entities,
+    relevance and instances are indexed by resource URI.
+    """
 
     def __init__(self, rdfdoc):
 	self.rdfdoc = rdfdoc
+	self.results = {}
+	self.entity_index = {}
+	self._node_types = {}
 	self.parseRelevance(rdfdoc.childNodes)
 	self.parseInstances(rdfdoc.childNodes)
 	self.results['entities'] = self.parseEntities(rdfdoc.childNodes)
@@ -20,28 +35,28 @@ class CalaisParser:
 	return rc
     
     def getNodeType(self, node):
+	# every parse pass asks for the type of every node, so remember it
+	try:
+	    return self._node_types[node]
+	except KeyError:
+	    pass
 	try:
 	    nodeType = node.getElementsByTagName('rdf:type')[0]
 	    resource = nodeType.getAttribute('rdf:resource').split('/')
-	    return resource[-2], resource[-1]
+	    result = resource[-2], resource[-1]
 	except:
-	    return None, None
+	    result = None, None
+	self._node_types[node] = result
+	return result
 	
     def lookupEntity(self, uri):
-	for etype, entities in self.results.get('entities', {}).items():
-	    for entity_uri, data in entities.items():
-		if uri == entity_uri:
-		    return data
+	return self.entity_index.get(uri)
 
     def lookupRelevance(self, uri):
-	for resource_uri, score in self.results.get('relevance', {}).items():
-	    if uri == resource_uri:
-		return score
+	return self.results.get('relevance', {}).get(uri)
 
     def lookupInstances(self, uri):
-	for resource_uri, data in self.results.get('instances', {}).items():
-	    if uri == resource_uri:
-		return data
+	return self.results.get('instances', {}).get(uri)
 
     def filterByType(self, node, nodeType):
 	main_type, sub_type = self.getNodeType(node)
@@ -87,7 +102,7 @@ class CalaisParser:
     
     def parseEntities(self, nodeList):
 	data = {}
-	print "Parsing entities..."
+	log.debug("Parsing entities...")
 	for node in nodeList:
 	    uri = node.getAttribute('rdf:about')
 	    ntype, etype = self.getNodeType(node)
@@ -98,11 +113,12 @@ class CalaisParser:
 			node.childNodes, relevance=True)})
 	    data[etype][uri]['_type'] = etype
 	    data[etype][uri]['relevance'] = self.lookupRelevance(uri)
+	    self.entity_index[uri] = data[etype][uri]
 	return data
 
     def parseRelations(self, nodeList):
 	data = {}
-	print "Parsing relations..."
+	log.debug("Parsing relations...")
 	for node in nodeList:
 	    uri = node.getAttribute('rdf:about')
 	    ntype, rtype = self.getNodeType(node)
@@ -141,3 +157,147 @@ class CalaisParser:
 		self.results['instances'][subject_uri] = []
 	    self.results['instances'][subject_uri].append(
 		self.getMetaData(node.childNodes, entities=False))
+
+
+RDF_NS = '{http://www.w3.org/1999/02/22-rdf-syntax-ns#}'
+CALAIS_NS = '{http://s.opencalais.com/1/pred/}'
+RDF_DESCRIPTION = RDF_NS + 'Description'
+RDF_ABOUT = RDF_NS + 'about'
+RDF_RESOURCE = RDF_NS + 'resource'
+RDF_TYPE = RDF_NS + 'type'
+
+
+class _Reference(object):
+    """
+    Placeholder for a reference to another resource, resolved once the
+    whole document has been read.
+    """
+    def __init__(self, uri):
+	self.uri = uri
+
+
+class CalaisRDFParser(object):
+    """
+    A single-pass, streaming parser for OpenCalais RDF responses.
+
+    Produces the same results structure as CalaisParser without building
+    a DOM: each rdf:Description is handled as soon as it has been read
+    and then discarded. Source may be a string or a file-like object.
+
+    If entity_callback is given, it is called with the URI and data of
+    each entity as it is parsed. An entity's relevance is only filled in
+    when its RelevanceInfo has been seen, which may be later in the
+    document; references from events and facts to entities are
+    resolved once the whole document has been read.
+    """
+    def __init__(self, source, entity_callback=None):
+	self.results = {'entities': {}, 'relations': {}}
+	self.entity_callback = entity_callback
+	self._resources = {}
+	self._relevance = {}
+	self._with_references = []
+	if isinstance(source, unicode):
+	    source = source.encode('utf8')
+	if isinstance(source, str):
+	    source = StringIO(source)
+	self.parse(source)
+
+    def parse(self, source):
+	depth = 0
+	root = None
+	for event, elem in iterparse(source, events=('start', 'end')):
+	    if event == 'start':
+		if root is None:
+		    root = elem
+		depth += 1
+		continue
+	    depth -= 1
+	    if depth == 1 and elem.tag == RDF_DESCRIPTION:
+		self.handleDescription(elem)
+		# drop everything read so far to keep memory flat
+		root.clear()
+	self.resolve()
+
+    def getNodeType(self, elem):
+	type_elem = elem.find(RDF_TYPE)
+	if type_elem is None:
+	    return None, None
+	resource = type_elem.get(RDF_RESOURCE, '').split('/')
+	if len(resource) < 2:
+	    return None, None
+	return resource[-2], resource[-1]
+
+    def getSubjectURI(self, elem):
+	return elem.find(CALAIS_NS + 'subject').get(RDF_RESOURCE)
+
+    def getMetaData(self, elem, entities=True):
+	data = {}
+	has_references = False
+	for child in elem:
+	    if not child.tag.startswith(CALAIS_NS):
+		continue
+	    key = child.tag[len(CALAIS_NS):]
+	    if child.text:
+		value = unicode(child.text)
+	    else:
+		resource_uri = child.get(RDF_RESOURCE)
+		if not (resource_uri and entities):
+		    continue
+		value = _Reference(resource_uri)
+		has_references = True
+	    if key in data:
+		if not isinstance(data[key], list):
+		    data[key] = [data[key]]
+		data[key].append(value)
+	    else:
+		data[key] = value
+	if has_references:
+	    self._with_references.append(data)
+	return data
+
+    def handleDescription(self, elem):
+	ntype, stype = self.getNodeType(elem)
+	if stype == 'RelevanceInfo':
+	    subject_uri = self.getSubjectURI(elem)
+	    score = float(elem.find(CALAIS_NS + 'relevance').text)
+	    self.results.setdefault('relevance', {})[subject_uri] = score
+	    self._relevance[subject_uri] = score
+	    if subject_uri in self._resources:
+		self._resources[subject_uri]['relevance'] = score
+	elif stype == 'InstanceInfo':
+	    subject_uri = self.getSubjectURI(elem)
+	    instances = self.results.setdefault('instances', {})
+	    instances.setdefault(subject_uri, []).append(
+		self.getMetaData(elem, entities=False))
+	elif ntype in ('e', 'r'):
+	    uri = elem.get(RDF_ABOUT)
+	    data = self.getMetaData(elem)
+	    data['_type'] = stype
+	    data['relevance'] = self._relevance.get(uri)
+	    if ntype == 'e':
+		group = self.results['entities']
+		self._resources[uri] = data
+	    else:
+		group = self.results['relations']
+	    group.setdefault(stype, {})[uri] = data
+	    if ntype == 'e' and self.entity_callback is not None:
+		self.entity_callback(uri, data)
+
+    def lookupEntity(self, uri):
+	data = self._resources.get(uri)
+	if data is None:
+	    # not an entity we know about; keep the reference itself
+	    return {'uri': uri, 'relevance': self._relevance.get(uri)}
+	data['uri'] = uri
+	return data
+
+    def resolve(self):
+	for data in self._with_references:
+	    for key, value in data.items():
+		if isinstance(value, _Reference):
+		    data[key] = self.lookupEntity(value.uri)
+		elif isinstance(value, list):
+		    data[key] = [isinstance(item, _Reference) and
+				 self.lookupEntity(item.uri) or item
+				 for item in value]
+	self._with_references = []
@@ -0,0 +1,157 @@
+"""
+A small keep-alive HTTP connection pool.
+
+``urllib2`` opens a new connection for every request, so each call to
+the OpenCalais API pays for a fresh TCP (and possibly TLS) handshake.
+``ConnectionPool`` keeps idle ``httplib`` connections around and hands
+them out again, holding at most ``max_size`` connections per host.
+"""
+import errno, httplib, socket, threading, urlparse, Queue
+
+# errors sending on a connection the server has already closed
+STALE_ERRNOS = (errno.ECONNRESET, errno.EPIPE)
+
+
+class PoolTimeout(IOError):
+    """
+    Raised when no connection to a host became free within the pool's
+    timeout.
+    """
+    pass
+
+
+class PooledResponse(object):
+    """
+    Wraps an ``httplib.HTTPResponse``. Closing it returns the connection
+    to its pool if the body was read completely and the server agreed
+    to keep the connection alive; otherwise the connection is closed.
+    """
+    def __init__(self, response, conn, queue):
+        self._response = response
+        self._conn = conn
+        self._queue = queue
+        self.status = response.status
+        self.reason = response.reason
+
+    def getheader(self, name, default=None):
+        return self._response.getheader(name, default)
+
+    def read(self, amt=None):
+        return self._response.read(amt)
+
+    def close(self):
+        if self._queue is None:
+            return
+        conn, queue = self._conn, self._queue
+        self._conn = self._queue = None
+        if self._response.isclosed() and not self._response.will_close:
+            queue.put(conn)
+        else:
+            self._response.close()
+            conn.close()
+            queue.put(None)
+
+
+class ConnectionPool(object):
+    """
+    A thread-safe pool of persistent HTTP connections, keyed by scheme
+    and host. Each host gets at most ``max_size`` connections; a thread
+    asking for one while all are in use waits up to ``timeout`` seconds
+    for another thread to give one back.
+    """
+    def __init__(self, max_size=4, timeout=60):
+        self.max_size = max_size
+        self.timeout = timeout
+        self._queues = {}
+        self._lock = threading.Lock()
+
+    def _get_queue(self, key):
+        self._lock.acquire()
+        try:
+            queue = self._queues.get(key)
+            if queue is None:
+                # ``None`` marks a free slot without an open connection
+                queue = Queue.LifoQueue(self.max_size)
+                for i in range(self.max_size):
+                    queue.put(None)
+                self._queues[key] = queue
+            return queue
+        finally:
+            self._lock.release()
+
+    def _new_connection(self, scheme, host):
+        if scheme == 'https':
+            return httplib.HTTPSConnection(host, timeout=self.timeout)
+        return httplib.HTTPConnection(host, timeout=self.timeout)
+
+    def _send_reused(self, conn, method, path, body, headers):
+        """
+        Send a request on a kept-alive connection and return the
+        ``httplib`` response, or ``None`` if the server had closed the
+        connection before answering. Any other error, such as a
+        timeout, is raised: the request may have reached the server.
+        """
+        try:
+            conn.request(method, path, body, headers)
+        except socket.error, e:
+            if e.errno not in STALE_ERRNOS:
+                raise
+            return None
+        try:
+            return conn.getresponse()
+        except httplib.BadStatusLine:
+            return None
+
+    def urlopen(self, method, url, body=None, headers=None):
+        """
+        Send a request and return a ``PooledResponse``. The caller
+        must ``close()`` the response to release the connection.
+        """
+        parts = urlparse.urlsplit(url)
+        key = (parts.scheme, parts.netloc)
+        path = parts.path or '/'
+        if parts.query:
+            path = '%s?%s' % (path, parts.query)
+        headers = headers or {}
+        queue = self._get_queue(key)
+        try:
+            conn = queue.get(True, self.timeout)
+        except Queue.Empty:
+            raise PoolTimeout('No free connection to %s' % parts.netloc)
+        try:
+            if conn is not None:
+                response = self._send_reused(conn, method, path, body,
+                                             headers)
+                if response is not None:
+                    return PooledResponse(response, conn, queue)
+                # The server dropped the idle keep-alive connection;
+                # retry once on a fresh one.
+                conn.close()
+            conn = self._new_connection(*key)
+            conn.request(method, path, body, headers)
+            return PooledResponse(conn.getresponse(), conn, queue)
+        except:
+            if conn is not None:
+                conn.close()
+            queue.put(None)
+            raise
+
+    def close(self):
+        """
+        Close every idle connection held by the pool.
+        """
+        self._lock.acquire()
+        try:
+            for queue in self._queues.values():
+                conns = []
+                while True:
+                    try:
+                        conns.append(queue.get_nowait())
+                    except Queue.Empty:
+                        break
+                for conn in conns:
+                    if conn is not None:
+                        conn.close()
+                    queue.put(None)
+        finally:
+            self._lock.release()
@@ -0,0 +1,186 @@
+"""
+Typed, queryable copies of Calais attributes.
+
+The extra attributes of ``Entity`` and ``EventFact`` objects are stored
+serialized, so the ORM cannot filter on them. A projection is an
+ordinary model with a ``ForeignKey`` (or ``OneToOneField``) to
+``Entity`` or ``EventFact`` and a column for each attribute you want to
+query. Register it for a Calais type and djangocalais keeps its rows in
+sync whenever objects of that type are stored::
+
+    from djangocalais import projections
+    from djangocalais.models import Entity
+
+    class Person(models.Model):
+        entity = models.OneToOneField(Entity, primary_key=True)
+        nationality = models.CharField(max_length=100, null=True,
+                                       db_index=True)
+        person_type = models.CharField(max_length=100, null=True)
+
+    projections.register(Person, 'Person', person_type='persontype')
+
+    Person.objects.filter(nationality='American')
+
+Each keyword argument maps a field of the projection to the attribute
+it is copied from; fields that are not mentioned are copied from the
+attribute of the same name. An attribute may be a dotted path into a
+referenced entity (``'company.name'``) or a callable that is given the
+attributes dictionary. Missing attributes and values that cannot be
+converted to the field's type are stored as ``None``, so projection
+fields should allow ``NULL``.
+
+Objects stored before a projection was registered are copied with the
+``calais_build_projections`` management command.
+"""
+from django.core.exceptions import ValidationError
+from django.db.models import AutoField, ForeignKey
+from django.db.models.signals import post_save
+from djangocalais.upsert import insert_ignore
+
+# Maximum number of source objects whose rows are replaced per query
+BATCH_SIZE = 500
+
+
+class Projection(object):
+    """
+    A registered projection ``model`` of the Calais type
+    ``calais_type``.
+    """
+    def __init__(self, model, calais_type, attributes):
+        from djangocalais.models import Entity, EventFact
+        self.model = model
+        self.calais_type = calais_type
+        self.link = None
+        for field in model._meta.fields:
+            if isinstance(field, ForeignKey) and \
+                    field.rel.to in (Entity, EventFact):
+                self.link = field
+                break
+        if self.link is None:
+            raise TypeError('%s has no ForeignKey to Entity or EventFact.'
+                            % model.__name__)
+        self.source = self.link.rel.to
+        self.attributes = {}
+        for field in model._meta.fields:
+            if field is self.link or isinstance(field, AutoField):
+                continue
+            self.attributes[field.name] = attributes.pop(field.name,
+                                                         field.name)
+        if attributes:
+            raise TypeError('%s has no field named %s.'
+                            % (model.__name__, attributes.keys()[0]))
+
+    def extract(self, data, field_name):
+        path = self.attributes[field_name]
+        if callable(path):
+            return path(data)
+        value = data
+        for key in path.split('.'):
+            if not isinstance(value, dict):
+                return None
+            value = value.get(key)
+        return value
+
+    def build(self, obj):
+        """
+        Return an unsaved projection row for the source object ``obj``.
+        """
+        data = obj.attributes or {}
+        values = {self.link.attname: obj.pk}
+        for field_name in self.attributes:
+            value = self.extract(data, field_name)
+            if value is not None:
+                field = self.model._meta.get_field(field_name)
+                try:
+                    value = field.to_python(value)
+                except (ValidationError, TypeError, ValueError):
+                    value = None
+            values[field_name] = value
+        return self.model(**values)
+
+    def sync(self, objs):
+        """
+        Replace the projection rows of the saved source objects
+        ``objs``.
+        """
+        objs = list(objs)
+        manager = self.model._default_manager
+        for i in range(0, len(objs), BATCH_SIZE):
+            batch = objs[i:i + BATCH_SIZE]
+            manager.filter(**{'%s__in' % self.link.name:
+                              [obj.pk for obj in batch]}).delete()
+            insert_ignore(self.model, [self.build(obj) for obj in batch])
+
+
+class ProjectionRegistry(object):
+    """
+    The projections registered for each Calais type.
+    """
+    def __init__(self):
+        self._projections = {}
+
+    def register(self, model, calais_type, **attributes):
+        """
+        Keep ``model`` in sync with every ``Entity`` or ``EventFact``
+        of ``calais_type``. See the module documentation.
+        """
+        projection = Projection(model, calais_type, attributes)
+        self._projections.setdefault((projection.source, calais_type),
+                                     []).append(projection)
+        post_save.connect(self.handle_save, sender=projection.source,
+                          dispatch_uid='djangocalais.projections.%s'
+                                       % projection.source.__name__)
+        return projection
+
+    def unregister(self, model):
+        for key, projections in self._projections.items():
+            projections[:] = [p for p in projections if p.model is not model]
+            if not projections:
+                del self._projections[key]
+
+    def get_projections(self, source=None):
+        """
+        Return every registered ``Projection``, or only those of the
+        ``source`` model (``Entity`` or ``EventFact``).
+        """
+        return [projection
+                for (model, calais_type), projections
+                in self._projections.items()
+                for projection in projections
+                if source is None or model is source]
+
+    def calais_type(self, obj):
+        data = obj.attributes
+        if isinstance(data, dict) and '_type' in data:
+            return data['_type']
+        return obj.type.name
+
+    def sync(self, objs):
+        """
+        Update the projections of the saved ``Entity`` and
+        ``EventFact`` objects among ``objs``. Other objects are
+        ignored.
+        """
+        if not self._projections:
+            return
+        groups = {}
+        for obj in objs:
+            model = obj.__class__
+            if not any([source is model
+                        for source, calais_type in self._projections]):
+                continue
+            key = (model, self.calais_type(obj))
+            if key in self._projections:
+                groups.setdefault(key, []).append(obj)
+        for key, group in groups.items():
+            for projection in self._projections[key]:
+                projection.sync(group)
+
+    def handle_save(self, sender, instance, raw=False, **kwargs):
+        if not raw:
+            self.sync([instance])
+
+registry = ProjectionRegistry()
+
+def register(model, calais_type, **attributes):
+    return registry.register(model, calais_type, **attributes)
@@ -0,0 +1,82 @@
+"""
+Client-side rate limiting for the OpenCalais API.
+"""
+import threading, time
+
+
+class RateLimiter(object):
+    """
+    A thread-safe token bucket. At most ``rate`` requests per second
+    may start (with bursts of up to ``burst``), and at most
+    ``max_concurrent`` may be in progress at once. Either limit can be
+    ``None`` to disable it.
+
+    Every successful :meth:`acquire` must be matched by a
+    :meth:`release` once the request has finished. :meth:`pause` holds
+    back all requests for a while, which is how the client backs off
+    when the API says it is being throttled.
+    """
+    def __init__(self, rate=None, burst=1, max_concurrent=None):
+        self.rate = rate
+        self.burst = max(burst, 1)
+        self.max_concurrent = max_concurrent
+        self._tokens = float(self.burst)
+        self._updated = time.time()
+        self._paused_until = 0
+        self._active = 0
+        self._cond = threading.Condition()
+
+    def _refill(self, now):
+        if self.rate is not None:
+            self._tokens = min(float(self.burst), self._tokens +
+                               (now - self._updated) * self.rate)
+        self._updated = now
+
+    def acquire(self, deadline=None):
+        """
+        Block until a request may start. Returns ``False`` if the
+        ``deadline`` (a ``time.time()`` value) passes first.
+        """
+        self._cond.acquire()
+        try:
+            while True:
+                now = time.time()
+                self._refill(now)
+                wait = None
+                if now < self._paused_until:
+                    wait = self._paused_until - now
+                elif self.max_concurrent is None or \
+                        self._active < self.max_concurrent:
+                    if self.rate is None or self._tokens >= 1:
+                        if self.rate is not None:
+                            self._tokens -= 1
+                        self._active += 1
+                        return True
+                    wait = (1 - self._tokens) / self.rate
+                if deadline is not None:
+                    if now >= deadline:
+                        return False
+                    if wait is None or wait > deadline - now:
+                        wait = deadline - now
+                self._cond.wait(wait)
+        finally:
+            self._cond.release()
+
+    def release(self):
+        self._cond.acquire()
+        try:
+            self._active -= 1
+            self._cond.notify()
+        finally:
+            self._cond.release()
+
+    def pause(self, seconds):
+        """
+        Hold back every request for at least ``seconds``.
+        """
+        self._cond.acquire()
+        try:
+            self._paused_until = max(self._paused_until,
+                                     time.time() + seconds)
+        finally:
+            self._cond.release()
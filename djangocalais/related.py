@@ -0,0 +1,311 @@
+"""
+Related documents, scored by the entities, social tags and topics
+they share.
+
+Each document is a sparse vector with one weight per item detected in
+it: the relevance of an entity, ``1 / importance`` of a social tag or
+the score of a topic, multiplied by the weight of its kind in
+``CALAIS_RELATED_WEIGHTS`` and by the item's inverse document
+frequency, so that items found in many documents count for less. Two
+documents are as similar as the cosine of their vectors.
+
+The best ``CALAIS_RELATED_LIMIT`` (default 10) neighbours of each
+document are stored as ``RelatedDocument`` rows, so that
+``CalaisDocument.get_related()`` is a single query. Compute them for
+every document with::
+
+    python manage.py calais_build_related
+
+which multiplies the sparse document-item matrix by its transpose with
+SciPy if it is installed, and otherwise accumulates the same scores in
+pure Python. With ``CALAIS_RELATED_DOCUMENTS = True`` in your settings,
+each document is also updated incrementally as it is analyzed: its
+neighbours are found among the ``CALAIS_RELATED_CANDIDATES`` (default
+100) best documents of each of its items, and it is added to their own
+lists. Document frequencies drift as documents are added, so rebuild
+from time to time.
+"""
+import heapq, math
+from django.conf import settings
+from django.db import connections, transaction
+from django.db.models import Count
+from djangocalais.models import CalaisDocument, EntityDetection, \
+     SocialTagDetection, TopicDetection, RelatedDocument
+from djangocalais.upsert import insert_ignore
+
+RELATED_LIMIT = getattr(settings, 'CALAIS_RELATED_LIMIT', 10)
+RELATED_CANDIDATES = getattr(settings, 'CALAIS_RELATED_CANDIDATES', 100)
+RELATED_WEIGHTS = getattr(settings, 'CALAIS_RELATED_WEIGHTS', {})
+
+# (kind, detection model, item field, score field)
+FEATURES = (('entities', EntityDetection, 'entity', 'relevance'),
+            ('social_tags', SocialTagDetection, 'social_tag', 'importance'),
+            ('topics', TopicDetection, 'topic', 'score'))
+
+BATCH_SIZE = 500
+
+# Most posting lists read by one query
+UNION_SIZE = 100
+
+
+def _weight(kind, value):
+    if kind == 'social_tags':
+        # importance 1 is the most important
+        value = 1.0 / max(value, 1)
+    return RELATED_WEIGHTS.get(kind, 1.0) * float(value)
+
+def _idf(df, n_documents):
+    return math.log((1.0 + n_documents) / (1.0 + df)) + 1.0
+
+def _in_batches(values):
+    values = list(values)
+    for i in range(0, len(values), BATCH_SIZE):
+        yield values[i:i + BATCH_SIZE]
+
+def iter_features(documents=None):
+    """
+    Yield a ``(document id, (kind, item id), weight)`` triple for every
+    detection, or only for those of the ``documents`` ids.
+    """
+    for kind, model, field, score in FEATURES:
+        if documents is None:
+            batches = [model._default_manager.all()]
+        else:
+            batches = [model._default_manager.filter(document__in=batch)
+                       for batch in _in_batches(documents)]
+        for queryset in batches:
+            rows = queryset.values_list('document', field, score).iterator()
+            for document_id, item_id, value in rows:
+                yield document_id, (kind, item_id), _weight(kind, value)
+
+def _normalize(vectors, df, n_documents):
+    """
+    Apply inverse document frequencies to ``vectors`` (dictionaries of
+    feature weights keyed by document id) and scale each to length 1.
+    """
+    for vector in vectors.values():
+        for feature in vector:
+            vector[feature] *= _idf(df[feature], n_documents)
+        norm = math.sqrt(sum([w * w for w in vector.values()])) or 1.0
+        for feature in vector:
+            vector[feature] /= norm
+
+def _top(scores, limit):
+    return heapq.nlargest(limit, scores.items(),
+                          key=lambda (document, score): (score, -document))
+
+def _neighbours_python(triples, n_documents, limit):
+    vectors, postings, df = {}, {}, {}
+    for document, feature, weight in triples:
+        vectors.setdefault(document, {})[feature] = weight
+        df[feature] = df.get(feature, 0) + 1
+    _normalize(vectors, df, n_documents)
+    for document, vector in vectors.items():
+        for feature, weight in vector.items():
+            postings.setdefault(feature, []).append((document, weight))
+    for document, vector in vectors.items():
+        scores = {}
+        for feature, weight in vector.items():
+            for other, other_weight in postings[feature]:
+                if other != document:
+                    scores[other] = scores.get(other, 0) + \
+                                    weight * other_weight
+        yield document, _top(scores, limit)
+
+def _neighbours_scipy(triples, n_documents, limit, block_size=1000):
+    import numpy
+    from scipy import sparse
+    documents, features = {}, {}
+    rows, cols, data = [], [], []
+    for document, feature, weight in triples:
+        rows.append(documents.setdefault(document, len(documents)))
+        cols.append(features.setdefault(feature, len(features)))
+        data.append(weight)
+    if not documents:
+        return
+    ids = numpy.zeros(len(documents), dtype=numpy.int64)
+    for document, row in documents.items():
+        ids[row] = document
+    cols = numpy.array(cols)
+    matrix = sparse.csr_matrix((data, (rows, cols)),
+                               shape=(len(documents), len(features)))
+    df = numpy.bincount(cols, minlength=len(features))
+    idf = numpy.log((1.0 + n_documents) / (1.0 + df)) + 1.0
+    matrix = matrix.dot(sparse.diags(idf)).tocsr()
+    norms = numpy.sqrt(numpy.asarray(matrix.multiply(matrix).sum(axis=1))
+                       .ravel())
+    norms[norms == 0] = 1.0
+    matrix = sparse.diags(1.0 / norms).dot(matrix).tocsr()
+    transposed = matrix.T.tocsr()
+    for start in range(0, len(documents), block_size):
+        similarities = matrix[start:start + block_size].dot(transposed)
+        similarities = similarities.tocsr()
+        for i in range(similarities.shape[0]):
+            lo, hi = similarities.indptr[i], similarities.indptr[i + 1]
+            columns = similarities.indices[lo:hi]
+            values = similarities.data[lo:hi]
+            keep = columns != start + i
+            columns, values = columns[keep], values[keep]
+            if len(values) > limit:
+                best = numpy.argpartition(-values, limit)[:limit]
+                columns, values = columns[best], values[best]
+            scores = dict(zip(ids[columns].tolist(), values.tolist()))
+            yield int(ids[start + i]), _top(scores, limit)
+
+def _has_scipy():
+    try:
+        import numpy, scipy.sparse
+    except ImportError:
+        return False
+    return True
+
+def build(limit=None, use_scipy=None):
+    """
+    Compute the ``limit`` (by default ``CALAIS_RELATED_LIMIT``) best
+    neighbours of every document and replace the stored ones. SciPy is
+    used if it is installed, unless ``use_scipy`` is false. Returns the
+    number of documents with neighbours.
+    """
+    if limit is None:
+        limit = RELATED_LIMIT
+    if use_scipy is None:
+        use_scipy = _has_scipy()
+    triples = list(iter_features())
+    n_documents = CalaisDocument.objects.count()
+    if use_scipy:
+        neighbours = _neighbours_scipy(triples, n_documents, limit)
+    else:
+        neighbours = _neighbours_python(triples, n_documents, limit)
+    return _replace_all(neighbours)
+
+@transaction.commit_on_success
+def _replace_all(neighbours):
+    RelatedDocument.objects.all().delete()
+    count = 0
+    rows = []
+    for document, related in neighbours:
+        if related:
+            count += 1
+        for other, score in related:
+            rows.append(RelatedDocument(document_id=document,
+                                        related_id=other, score=score))
+        if len(rows) >= BATCH_SIZE:
+            insert_ignore(RelatedDocument, rows)
+            rows = []
+    insert_ignore(RelatedDocument, rows)
+    return count
+
+def _document_frequencies(features):
+    """
+    Return the number of documents each of ``features`` appears in.
+    """
+    df = dict([(feature, 0) for feature in features])
+    for kind, model, field, score in FEATURES:
+        items = [item for k, item in features if k == kind]
+        for batch in _in_batches(items):
+            counts = model._default_manager \
+                .filter(**{'%s__in' % field: batch}) \
+                .values(field).annotate(documents=Count('document'))
+            for row in counts:
+                df[(kind, row[field])] = row['documents']
+    return df
+
+def _postings(kind, model, field, score, item, candidates):
+    """
+    Return a query for the ids of the ``candidates`` best documents of
+    ``item``, read in order from its posting index.
+    """
+    if kind == 'social_tags':
+        # importance 1 is the most important
+        order = (score, '-document')
+    else:
+        order = ('-%s' % score, '-document')
+    return model._default_manager.filter(**{field: item}) \
+               .order_by(*order).values_list('document')[:candidates]
+
+def _candidates(vector, candidates):
+    """
+    Return the ids of the ``candidates`` best documents of each item
+    in ``vector``, read from the top of the posting list of each item.
+    The lists of up to ``UNION_SIZE`` items of one kind are read with a
+    single ``UNION ALL`` query.
+    """
+    documents = set()
+    for kind, model, field, score in FEATURES:
+        items = [item for k, item in vector if k == kind]
+        for i in range(0, len(items), UNION_SIZE):
+            selects, params = [], []
+            for item in items[i:i + UNION_SIZE]:
+                queryset = _postings(kind, model, field, score, item,
+                                     candidates)
+                sql, item_params = queryset.query.get_compiler(
+                    queryset.db).as_sql()
+                selects.append('SELECT * FROM (%s) p%d' % (sql,
+                                                           len(selects)))
+                params.extend(item_params)
+            cursor = connections[queryset.db].cursor()
+            cursor.execute(' UNION ALL '.join(selects), params)
+            documents.update([row[0] for row in cursor.fetchall()])
+    return documents
+
+def update_document(document, limit=None, candidates=None):
+    """
+    Recompute the ``limit`` best neighbours of ``document`` alone, and
+    add it to the lists of the documents it is now related to (or
+    update or remove it from those it was in). Neighbours are found
+    among the ``candidates`` (by default ``CALAIS_RELATED_CANDIDATES``)
+    best documents of each of its items. Returns its new neighbours
+    as ``(document id, score)`` pairs.
+    """
+    if limit is None:
+        limit = RELATED_LIMIT
+    if candidates is None:
+        candidates = RELATED_CANDIDATES
+    vector = {}
+    for document_id, feature, weight in iter_features([document.pk]):
+        vector[feature] = weight
+    others = _candidates(vector, candidates)
+    others.discard(document.pk)
+    vectors = {document.pk: vector}
+    for document_id, feature, weight in iter_features(others):
+        vectors.setdefault(document_id, {})[feature] = weight
+    features = set()
+    for v in vectors.values():
+        features.update(v)
+    _normalize(vectors, _document_frequencies(features),
+               CalaisDocument.objects.count())
+    scores = {}
+    for other in others:
+        score = sum([weight * vectors[other].get(feature, 0)
+                     for feature, weight in vector.items()])
+        if score > 0:
+            scores[other] = score
+    related = _top(scores, limit)
+
+    RelatedDocument.objects.filter(document=document).delete()
+    insert_ignore(RelatedDocument, [
+        RelatedDocument(document=document, related_id=other, score=score)
+        for other, score in related])
+    # keep this document's place in the lists of other documents right:
+    # rewrite its rows there, then trim the lists it was added to
+    listed = set(RelatedDocument.objects.filter(related=document)
+                 .values_list('document', flat=True))
+    RelatedDocument.objects.filter(related=document).delete()
+    added = set([other for other, score in related]) - listed
+    listed = (listed & set(scores)) | added
+    insert_ignore(RelatedDocument, [
+        RelatedDocument(document_id=other, related=document,
+                        score=scores[other])
+        for other in listed])
+    lists = {}
+    for batch in _in_batches(added):
+        rows = RelatedDocument.objects.filter(document__in=batch) \
+                   .values_list('pk', 'document', 'score', 'related')
+        for pk, other, score, related_id in rows:
+            lists.setdefault(other, []).append((-score, related_id, pk))
+    extra = []
+    for rows in lists.values():
+        extra.extend([pk for score, related_id, pk in sorted(rows)[limit:]])
+    for batch in _in_batches(extra):
+        RelatedDocument.objects.filter(pk__in=batch).delete()
+    return related
@@ -0,0 +1,2 @@
+-- Posting lists: the documents about each entity, by relevance
+CREATE INDEX djangocalais_entitydetection_postings ON djangocalais_entitydetection (entity_id, relevance, document_id);
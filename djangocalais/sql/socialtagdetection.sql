@@ -0,0 +1,2 @@
+-- Posting lists: the documents about each social tag, by importance
+CREATE INDEX djangocalais_socialtagdetection_postings ON djangocalais_socialtagdetection (social_tag_id, importance, document_id DESC);
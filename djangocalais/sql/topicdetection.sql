@@ -0,0 +1,2 @@
+-- Posting lists: the documents about each topic, by score
+CREATE INDEX djangocalais_topicdetection_postings ON djangocalais_topicdetection (topic_id, score, document_id);
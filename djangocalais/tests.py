@@ -0,0 +1,393 @@
+"""
+Tests for djangocalais. Run them with::
+
+    python manage.py test djangocalais
+"""
+import pickle
+import re
+from xml.dom import minidom
+from base64 import b64encode
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+from django.contrib.contenttypes.models import ContentType
+from django.db import connection
+from django.test import TestCase
+from django.utils import unittest
+from djangocalais import upsert
+from djangocalais.benchmark import make_rdf_response
+from djangocalais.calaisapi import OpenCalais, split_text
+from djangocalais.fields import (PickledObject, PickledObjectField,
+                                 _Encoded, dbsafe_encode, decode_value,
+                                 encode_value)
+from djangocalais.parser import CalaisParser, CalaisRDFParser
+from djangocalais.models import CalaisDocument, Entity, EntityType, Topic
+from djangocalais.upsert import get_or_insert, insert_ignore
+
+
+def topic(n):
+    return Topic(urlhash='http://d.opencalais.com/cat/%d' % n,
+                 name='Topic %d' % n)
+
+
+def result(entities, topics=()):
+    """
+    Return a Calais result with an entity of each name in ``entities``
+    and a topic of each name in ``topics``.
+    """
+    found = {}
+    for name in entities:
+        found['http://d.opencalais.com/e/%s' % name] = {
+            '_type': 'Company', '_typeGroup': 'entities',
+            '_typeReference': 'http://s.opencalais.com/1/type/em/e/Company',
+            'name': name, 'relevance': 0.5, 'instances': []}
+    return {'entities': found and {'Company': found} or {},
+            'topics': dict([('http://d.opencalais.com/dochash-1/cat/%s' % name,
+                             {'category': 'http://d.opencalais.com/cat/%s'
+                                          % name,
+                              'categoryName': name, 'score': 0.9})
+                            for name in topics])}
+
+
+class FakeCalais(object):
+    """
+    Stands in for ``OpenCalais``, answering with the result given for
+    each text (or ``{}``, as for a failed request).
+    """
+    def __init__(self, results):
+        self.results = results
+        self.texts = []
+
+    def analyze(self, text, content_type='text/txt', **kwargs):
+        self.texts.append(text)
+        return self.results.get(text, {})
+
+
+class UpsertTests(TestCase):
+    def test_insert_ignore_sets_pk(self):
+        obj = topic(1)
+        self.assertEqual(insert_ignore(Topic, [obj]), 1)
+        self.assertNotEqual(obj.pk, None)
+        self.assertEqual(Topic.objects.get(pk=obj.pk).name, 'Topic 1')
+
+    def test_insert_ignore_skips_duplicates(self):
+        insert_ignore(Topic, [topic(1)])
+        duplicate = topic(1)
+        self.assertEqual(insert_ignore(Topic, [duplicate]), 0)
+        self.assertEqual(duplicate.pk, None)
+        self.assertEqual(Topic.objects.count(), 1)
+
+    def test_insert_ignore_many(self):
+        insert_ignore(Topic, [topic(1)])
+        self.assertEqual(insert_ignore(Topic, [topic(1), topic(2),
+                                               topic(3), topic(2)]), 2)
+        self.assertEqual(sorted(Topic.objects.values_list('name', flat=True)),
+                         ['Topic 1', 'Topic 2', 'Topic 3'])
+        self.assertEqual(insert_ignore(Topic, []), 0)
+
+    def test_get_or_insert(self):
+        obj = topic(1)
+        found, created = get_or_insert(Topic, obj, urlhash=obj.urlhash)
+        self.assertTrue(created)
+        self.assertTrue(found is obj)
+        self.assertNotEqual(obj.pk, None)
+
+        found, created = get_or_insert(Topic, topic(1), urlhash=obj.urlhash)
+        self.assertFalse(created)
+        self.assertEqual(found.pk, obj.pk)
+        self.assertEqual(Topic.objects.count(), 1)
+
+    def test_get_or_insert_race(self):
+        def racing_insert(model, objs):
+            # another process inserts the row first, and the skipped
+            # insert is miscounted with a stale id
+            insert_ignore(model, [topic(1)])
+            objs[0].pk = 0
+            return 1
+        upsert.insert_ignore = racing_insert
+        try:
+            obj = topic(1)
+            found, created = get_or_insert(Topic, obj, urlhash=obj.urlhash)
+        finally:
+            upsert.insert_ignore = insert_ignore
+        self.assertFalse(created)
+        self.assertEqual(found.pk, Topic.objects.get().pk)
+        self.assertNotEqual(found.pk, 0)
+
+
+class MySQLCursor(object):
+    """
+    Runs the MySQL statements of ``insert_ignore`` on SQLite.
+    """
+    def __init__(self, cursor):
+        self.cursor = cursor
+
+    def execute(self, sql, params=()):
+        return self.cursor.execute(
+            sql.replace('INSERT IGNORE INTO', 'INSERT OR IGNORE INTO'),
+            params)
+
+    def __getattr__(self, name):
+        return getattr(self.cursor, name)
+
+
+class MySQLUpsertTests(UpsertTests):
+    """
+    The upsert tests, with ``insert_ignore`` taking its MySQL path.
+    """
+    def setUp(self):
+        cursor = connection.cursor
+        connection.vendor = 'mysql'
+        connection.cursor = lambda: MySQLCursor(cursor())
+
+    def tearDown(self):
+        del connection.vendor
+        del connection.cursor
+
+    def test_insert_sql(self):
+        self.assertEqual(upsert._insert_sql('mysql', lambda name: name, 't',
+                                            ['a', 'b'], 2),
+                         'INSERT IGNORE INTO t (a, b) VALUES (%s, %s), '
+                         '(%s, %s)')
+
+
+class DetectionRemovalTests(TestCase):
+    fields = [('name', 'text/txt'), ('model', 'text/txt')]
+
+    def setUp(self):
+        # a copy, not the instance get_for_model() caches for the process
+        self.obj = ContentType.objects.get(
+            pk=ContentType.objects.get_for_model(Topic).pk)
+        self.obj.name, self.obj.model = 'first', 'second'
+        self.api = FakeCalais({'first': result(['Apple', 'IBM'], ['Tech']),
+                               'second': result(['IBM', 'Intel']),
+                               'changed': result(['Nokia']),
+                               'changed again': result(['Apple'])})
+
+    def analyze(self, bulk):
+        document = CalaisDocument.objects.analyze(self.obj, self.fields,
+                                                  api=self.api, bulk=bulk)
+        names = sorted(document.entity_detections.values_list(
+            'entity__name', flat=True))
+        topics = sorted(document.topic_detections.values_list(
+            'topic__name', flat=True))
+        return names, topics
+
+    def check_changed_field(self, bulk):
+        self.assertEqual(self.analyze(bulk),
+                         (['Apple', 'IBM', 'Intel'], ['Tech']))
+        # only the field that changed is sent again; IBM is still in
+        # the other field, so its detection stays
+        self.obj.name = 'changed'
+        self.assertEqual(self.analyze(bulk), (['IBM', 'Intel', 'Nokia'], []))
+        self.assertEqual(self.api.texts, ['first', 'second', 'changed'])
+        self.obj.name = 'changed again'
+        self.assertEqual(self.analyze(bulk), (['Apple', 'IBM', 'Intel'], []))
+
+    def test_changed_field(self):
+        self.check_changed_field(False)
+
+    def test_changed_field_bulk(self):
+        self.check_changed_field(True)
+
+    def test_content_type_cache_untouched(self):
+        self.analyze(True)
+        content_type = ContentType.objects.get_for_model(Topic)
+        self.assertEqual(content_type.model_class(), Topic)
+
+    def test_queryset_db_writes(self):
+        queryset = ContentType.objects.filter(pk=self.obj.pk)
+        queryset.update(name='first')
+        stats = CalaisDocument.objects.analyze_queryset(
+            queryset, self.fields[:1], api=self.api)
+        # an entity type, two entities, a topic, three detections and
+        # the field's fingerprint
+        self.assertEqual(stats.db_writes, 8)
+        queryset.update(name='changed')
+        stats = CalaisDocument.objects.analyze_queryset(
+            queryset, self.fields[:1], api=self.api)
+        # three detections removed, Nokia and its detection added, and
+        # the fingerprint updated
+        self.assertEqual(stats.db_writes, 6)
+
+    def test_failed_field_keeps_detections(self):
+        self.analyze(True)
+        self.obj.name = 'unknown'
+        self.assertEqual(self.analyze(True),
+                         (['Apple', 'IBM', 'Intel'], ['Tech']))
+        # the field is sent again next time, since it was not stored
+        self.analyze(True)
+        self.assertEqual(self.api.texts.count('unknown'), 2)
+
+
+class ChunkedCalais(OpenCalais):
+    """
+    Answers each chunk with an Apple entity found at every occurrence,
+    and a social tag and a topic under keys unique to the chunk, as
+    Calais does.
+    """
+    def analyze(self, text, **kwargs):
+        n = 'computers' in text and 2 or 1
+        doc = 'http://d.opencalais.com/dochash-1/chunk-%d' % n
+        instances, offset = [], text.find('Apple')
+        while offset >= 0:
+            instances.append({'offset': offset, 'length': 5})
+            offset = text.find('Apple', offset + 1)
+        return {
+            'entities': {'Company': {'http://d.opencalais.com/e/Apple': {
+                'name': 'Apple', 'relevance': 0.5,
+                'instances': instances}}},
+            'socialTag': {'%s/SocialTag/1' % doc: {
+                'socialTag': 'http://d.opencalais.com/tag/Apple',
+                'name': 'Apple', 'importance': 3 - n}},
+            'topics': {'%s/cat/1' % doc: {
+                'category': 'http://d.opencalais.com/cat/Technology',
+                'categoryName': 'Technology', 'score': 0.4 * n}}}
+
+
+class ChunkedAnalysisTests(unittest.TestCase):
+    text = 'Apple sells phones.\n\nApple sells computers too.'
+
+    def test_split_text(self):
+        chunks = split_text(self.text, 30)
+        self.assertEqual(chunks, [(0, 'Apple sells phones.'),
+                                  (21, 'Apple sells computers too.')])
+        self.assertEqual(split_text(self.text, 100), [(0, self.text)])
+
+    def test_merge_results(self):
+        result = ChunkedCalais('key').analyze_chunked(self.text,
+                                                      size_limit=30)
+        apple = result['entities']['Company'].values()[0]
+        self.assertEqual([i['offset'] for i in apple['instances']], [0, 21])
+        self.assertEqual(len(result['socialTag']), 1)
+        self.assertEqual(result['socialTag'].values()[0]['importance'], 1)
+        self.assertEqual(len(result['topics']), 1)
+        self.assertEqual(result['topics'].values()[0]['score'], 0.8)
+
+
+class LazyFieldTests(TestCase):
+    def test_pickle_unread_attributes(self):
+        etype = EntityType.objects.create(name='Company', urlhash='x')
+        Entity.objects.create(urlhash='http://d.opencalais.com/e/1',
+                              type=etype, name='Apple',
+                              attributes={'ticker': 'AAPL'})
+        for protocol in (0, 1, 2):
+            entity = Entity.objects.get()
+            copy = pickle.loads(pickle.dumps(entity, protocol))
+            self.assertEqual(copy.attributes, {'ticker': 'AAPL'})
+
+    def test_pickle_binary_value(self):
+        value = pickle.loads(pickle.dumps(_Encoded(buffer('\x00json:1')), 0))
+        self.assertEqual(value.value, '\x00json:1')
+
+
+class EncodingTests(unittest.TestCase):
+    value = {'name': u'Caf\xe9', 'ticker': 'AAPL', 'scores': [1, 0.5]}
+
+    def round_trip(self, codec, **kwargs):
+        for binary in (False, True):
+            for compress_object in (False, True, 9):
+                encoded = encode_value(self.value, codec, compress_object,
+                                       binary)
+                self.assertEqual(encoded.startswith('\x00'), binary)
+                self.assertEqual(decode_value(encoded, compress_object),
+                                 self.value)
+                # binary columns are read back as buffers
+                if binary:
+                    self.assertEqual(decode_value(buffer(encoded)),
+                                     self.value)
+
+    def test_legacy_pickle(self):
+        # written by dbsafe_encode before codecs were tagged
+        legacy = b64encode(pickle.dumps(self.value))
+        self.assertEqual(decode_value(legacy), self.value)
+        self.assertEqual(decode_value(unicode(legacy)), self.value)
+        # and text pickles are still written that way
+        self.assertEqual(encode_value(self.value),
+                         dbsafe_encode(self.value))
+
+    def test_pickle(self):
+        self.round_trip('pickle')
+
+    def test_json(self):
+        self.round_trip('json')
+        self.assertTrue(encode_value(self.value, 'json').startswith('json:{'))
+
+    @unittest.skipIf(msgpack is None, 'msgpack is not installed')
+    def test_msgpack(self):
+        self.round_trip('msgpack')
+
+    def test_binary_column(self):
+        for codec in ('pickle', 'json'):
+            field = PickledObjectField(codec=codec, binary=True,
+                                       compress=True)
+            stored = field.get_db_prep_value(self.value)
+            self.assertTrue(isinstance(stored, buffer))
+            self.assertEqual(field.to_python(stored), self.value)
+            # a text value kept as it was loaded is stored unchanged
+            text = PickledObject(encode_value(self.value, codec, True))
+            self.assertEqual(str(field.get_db_prep_value(text)), text)
+
+
+# A relevance before its entity, and a relation that refers to an
+# entity defined after it. As in real responses, there is no
+# whitespace between elements.
+RDF = re.sub(r'>\s+<', '><', """<?xml version="1.0" encoding="utf-8"?>
+<rdf:RDF xmlns:rdf="http://www.w3.org/1999/02/22-rdf-syntax-ns#"
+         xmlns:c="http://s.opencalais.com/1/pred/">
+  <rdf:Description rdf:about="http://d.opencalais.com/doc/Relevance/1">
+    <rdf:type rdf:resource="http://s.opencalais.com/1/type/sys/RelevanceInfo"/>
+    <c:subject rdf:resource="http://d.opencalais.com/e/Apple"/>
+    <c:relevance>0.8</c:relevance>
+  </rdf:Description>
+  <rdf:Description rdf:about="http://d.opencalais.com/r/1">
+    <rdf:type rdf:resource="http://s.opencalais.com/1/type/em/r/Acquisition"/>
+    <c:company_acquirer rdf:resource="http://d.opencalais.com/e/Apple"/>
+    <c:status>announced</c:status>
+  </rdf:Description>
+  <rdf:Description rdf:about="http://d.opencalais.com/e/Apple">
+    <rdf:type rdf:resource="http://s.opencalais.com/1/type/em/e/Company"/>
+    <c:name>Apple Inc.</c:name>
+    <c:nationality>American</c:nationality>
+  </rdf:Description>
+  <rdf:Description rdf:about="http://d.opencalais.com/doc/Instance/1">
+    <rdf:type rdf:resource="http://s.opencalais.com/1/type/sys/InstanceInfo"/>
+    <c:subject rdf:resource="http://d.opencalais.com/e/Apple"/>
+    <c:exact>Apple</c:exact>
+    <c:offset>0</c:offset>
+    <c:length>5</c:length>
+  </rdf:Description>
+</rdf:RDF>""")
+
+
+class ParserTests(unittest.TestCase):
+    def assertSameResults(self, data):
+        expected = CalaisParser(minidom.parseString(data).documentElement)
+        self.assertEqual(CalaisRDFParser(data).results, expected.results)
+
+    def test_same_results(self):
+        self.assertSameResults(RDF)
+        self.assertSameResults(make_rdf_response(50))
+
+    def test_entity_callback(self):
+        found = []
+        results = CalaisRDFParser(
+            RDF, lambda uri, data: found.append((uri, data))).results
+        uri = 'http://d.opencalais.com/e/Apple'
+        apple = results['entities']['Company'][uri]
+        self.assertEqual(found, [(uri, apple)])
+        self.assertTrue(found[0][1] is apple)
+        self.assertEqual(apple['name'], 'Apple Inc.')
+
+    def test_unknown_reference(self):
+        # the minidom parser fails on these
+        data = RDF.replace('<c:status>', '<c:company_beingacquired '
+                           'rdf:resource="http://d.opencalais.com/e/X"/>'
+                           '<c:status>')
+        relation = CalaisRDFParser(data).results['relations'][
+            'Acquisition']['http://d.opencalais.com/r/1']
+        self.assertEqual(relation['company_beingacquired'],
+                         {'uri': 'http://d.opencalais.com/e/X',
+                          'relevance': None})
+        self.assertEqual(relation['company_acquirer']['relevance'], 0.8)
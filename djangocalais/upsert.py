@@ -0,0 +1,112 @@
+"""
+Race-free inserts against unique keys.
+
+``get_or_create`` reads before it writes, so two processes storing the
+same entity at once can both miss the read and insert duplicates.
+``insert_ignore`` instead asks the database to skip rows that would
+violate a unique constraint, using ``INSERT ... ON CONFLICT DO
+NOTHING`` on PostgreSQL (9.5 or later), ``INSERT OR IGNORE`` on SQLite
+and ``INSERT IGNORE`` on MySQL. Other databases fall back to saving
+each row inside a savepoint and ignoring ``IntegrityError``.
+
+Django connects to MySQL with ``CLIENT.FOUND_ROWS``, under which
+``ON DUPLICATE KEY UPDATE`` reports a skipped row as changed, so it
+cannot be used to count the rows inserted.
+"""
+from django.db import connections, router, transaction, IntegrityError
+from django.db.models import AutoField
+
+# Most placeholders allowed in one statement (SQLite's default limit)
+MAX_PARAMS = 999
+
+# Maximum number of rows in one ``INSERT`` statement
+MAX_ROWS = 500
+
+
+def _insert_sql(vendor, qn, table, columns, rows):
+    placeholders = '(%s)' % ', '.join(['%s'] * len(columns))
+    values = ', '.join([placeholders] * rows)
+    columns = ', '.join([qn(column) for column in columns])
+    if vendor == 'sqlite':
+        return 'INSERT OR IGNORE INTO %s (%s) VALUES %s' % (table, columns,
+                                                             values)
+    if vendor == 'postgresql':
+        return 'INSERT INTO %s (%s) VALUES %s ON CONFLICT DO NOTHING' % (
+            table, columns, values)
+    if vendor == 'mysql':
+        return 'INSERT IGNORE INTO %s (%s) VALUES %s' % (table, columns,
+                                                         values)
+    return None
+
+def insert_ignore(model, objs):
+    """
+    Insert the unsaved ``objs`` of ``model``, skipping any that clash
+    with an existing row on a unique column. Returns the number of
+    rows inserted. When a single object is inserted, its primary key
+    is set.
+    """
+    if not objs:
+        return 0
+    using = router.db_for_write(model)
+    connection = connections[using]
+    opts = model._meta
+    fields = [f for f in opts.local_fields if not isinstance(f, AutoField)]
+    qn = connection.ops.quote_name
+    table = qn(opts.db_table)
+    columns = [f.column for f in fields]
+    if _insert_sql(connection.vendor, qn, table, columns, 1) is None:
+        return _save_ignore(objs, using)
+    rows_per_statement = max(1, min(MAX_ROWS, MAX_PARAMS // len(fields)))
+    cursor = connection.cursor()
+    inserted = 0
+    for i in range(0, len(objs), rows_per_statement):
+        batch = objs[i:i + rows_per_statement]
+        params = []
+        for obj in batch:
+            for f in fields:
+                params.append(f.get_db_prep_save(f.pre_save(obj, True),
+                                                 connection=connection))
+        cursor.execute(_insert_sql(connection.vendor, qn, table, columns,
+                                   len(batch)), params)
+        if cursor.rowcount > 0:
+            inserted += cursor.rowcount
+    if len(objs) == 1 and inserted == 1:
+        setattr(objs[0], opts.pk.attname, connection.ops.last_insert_id(
+            cursor, opts.db_table, opts.pk.column))
+    transaction.commit_unless_managed(using=using)
+    return inserted
+
+def _save_ignore(objs, using):
+    inserted = 0
+    for obj in objs:
+        sid = transaction.savepoint(using=using)
+        try:
+            obj.save(force_insert=True, using=using)
+        except IntegrityError:
+            transaction.savepoint_rollback(sid, using=using)
+        else:
+            transaction.savepoint_commit(sid, using=using)
+            inserted += 1
+    return inserted
+
+def get_or_insert(model, obj, **lookup):
+    """
+    Return a tuple of the row of ``model`` matching ``lookup``,
+    inserting ``obj`` if there is none, and whether it was inserted.
+    Unlike ``get_or_create``, this is safe against concurrent inserts
+    as long as ``lookup`` is covered by a unique constraint: if another
+    process inserts the row first, that row is returned.
+
+    The row is read back after inserting rather than trusting the id
+    the database reports, which may be stale if the insert was skipped.
+    """
+    manager = model._default_manager
+    try:
+        return manager.get(**lookup), False
+    except model.DoesNotExist:
+        pass
+    inserted = insert_ignore(model, [obj])
+    row = manager.get(**lookup)
+    if inserted and row.pk == obj.pk:
+        return obj, True
+    return row, False
@@ -0,0 +1,47 @@
+"""
+Small helpers shared by the djangocalais modules.
+"""
+import sys, threading, Queue
+
+
+def parallel_map(func, items, workers=1):
+    """
+    Like ``map``, but calls ``func`` on up to ``workers`` items at once,
+    each in its own thread. Results keep the order of ``items``. If
+    ``func`` raises, the first exception is re-raised once every
+    thread has finished.
+
+    This is meant for I/O-bound work such as OpenCalais requests; with
+    ``workers`` of 1 it is exactly ``map``.
+    """
+    items = list(items)
+    if workers <= 1 or len(items) <= 1:
+        return map(func, items)
+    results = [None] * len(items)
+    errors = []
+    queue = Queue.Queue()
+    for i, item in enumerate(items):
+        queue.put((i, item))
+
+    def worker():
+        while True:
+            try:
+                i, item = queue.get_nowait()
+            except Queue.Empty:
+                return
+            try:
+                results[i] = func(item)
+            except Exception:
+                errors.append(sys.exc_info())
+
+    threads = [threading.Thread(target=worker)
+               for n in range(min(workers, len(items)))]
+    for thread in threads:
+        thread.setDaemon(True)
+        thread.start()
+    for thread in threads:
+        thread.join()
+    if errors:
+        exc_type, exc_value, tb = errors[0]
+        raise exc_type, exc_value, tb
+    return results
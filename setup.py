@@ -9,4 +9,6 @@ setup(name='django-calais',
       author_email='jesse.legg@gmail.com',
       url='http://code.google.com/p/django-calais/',
       license='MIT License',
-      packages=['djangocalais'])
+      packages=['djangocalais', 'djangocalais.management',
+                'djangocalais.management.commands'],
+      package_data={'djangocalais': ['sql/*.sql']})